@@ -5,7 +5,7 @@ VERSION="1.2.0"
 
 # Function to display help
 display_help() {
-    echo "Usage: $0 [option] --reference <reference_file> --fragments <fragments_file> [--cigar] [--threads <thread_num>] [--k <num>] [--w <num>] [--f <num>] [--debug]"
+    echo "Usage: $0 [option] --reference <reference_file> --fragments <fragments_file> [--cigar] [--threads <thread_num>] [--engine threads|processes] [--k <num>] [--w <num>] [--f <num>] [--band <num>] [--align-mode region|chain] [--max-band-cells <num>] [--min-chain-score <num>] [--max-chains <num>] [--x-drop <num>] [--max-occurrences <num>] [--min-anchors <num>] [--min-anchor-density <num>] [--min-chain-coverage <num>] [--sample <num> [--seed <num>]] [--ordered] [--index-dir <dir>] [--rebuild-index] [--build-index] [--serve [--socket <path>|--port <num>]] [--plot coverage|reads|none] [--profile] [--trace-memory] [--debug]"
     echo
     echo "Options:"
     echo "  -h, --help        Display this help message and exit"
@@ -13,12 +13,35 @@ display_help() {
     echo
     echo "Arguments:"
     echo "  --reference       Path to the reference genome file (FASTA format)"
-    echo "  --fragments       Path to the fragments file (FASTA or FASTQ format)"
+    echo "  --fragments       Path to the fragments file (FASTA or FASTQ format), not needed with --serve"
     echo "  --cigar           Include the CIGAR string in the output"
     echo "  --threads         Number of threads to use"
+    echo "  --engine          threads (default) or processes: map fragments in worker processes"
     echo "  --k               Value for parameter k"
     echo "  --w               Value for parameter w"
     echo "  --f               Value for parameter f"
+    echo "  --band            Half-width of the alignment band (adaptive if not set)"
+    echo "  --align-mode      region (default, skips reads over 5000 bp) or chain: align only the gaps between chained anchors"
+    echo "  --max-band-cells  Keep only checkpoint rows of the band above this many band cells"
+    echo "  --min-chain-score Skip fragments whose best chain scores below this"
+    echo "  --max-chains      Number of chains kept per fragment (secondary hits)"
+    echo "  --x-drop          Score drop that stops extending alignment ends (0: fixed 50 bp padding)"
+    echo "  --max-occurrences Ignore fragment minimizers seen more often than this in the reference (0: no cap)"
+    echo "  --min-anchors     Skip fragments, and drop chains, with fewer anchors"
+    echo "  --min-anchor-density Skip fragments with fewer anchors per kb before chaining"
+    echo "  --min-chain-coverage Skip fragments whose best chain spans less than this fraction of them"
+    echo "  --sample          Map a seeded random sample of this many fragments instead of all of them"
+    echo "  --seed            Random seed for --sample (default 0)"
+    echo "  --ordered         Write results in input order instead of as they complete"
+    echo "  --index-dir       Directory for the cached reference minimizer index"
+    echo "  --rebuild-index   Rebuild the cached minimizer index even if it exists"
+    echo "  --build-index     Only build the cached minimizer index, then exit"
+    echo "  --serve           Keep the reference and index loaded and map reads sent over a local socket"
+    echo "  --socket          Unix domain socket path for --serve"
+    echo "  --port            Localhost TCP port for --serve (default 7878)"
+    echo "  --plot            coverage (default): write a coverage and pileup PNG/SVG, reads: one line per read in a window, none: no plot"
+    echo "  --profile         Write a cProfile dump of the run, worker threads (and processes before Python 3.12) included, next to the output"
+    echo "  --trace-memory    Add tracemalloc peak and top allocations to the metrics summary"
     echo "  --debug           Enable debug mode in the Python script"
     echo
 }
@@ -33,9 +56,20 @@ fi
 DEBUG_MODE=""
 CIGAR_FLAG=""
 THREADS=""
+ENGINE=""
 K_VALUE=""
 W_VALUE=""
 F_VALUE=""
+BAND_VALUE=""
+ALIGN_MODE=""
+MAX_BAND_CELLS=""
+CHAIN_FLAGS=""
+INDEX_DIR=""
+INDEX_FLAGS=""
+SERVE_FLAGS=""
+PROFILE_FLAGS=""
+PLOT_FLAG=""
+SCHEDULE_FLAGS=""
 
 # Parse command-line arguments
 while [[ "$#" -gt 0 ]]; do
@@ -78,6 +112,15 @@ while [[ "$#" -gt 0 ]]; do
                 exit 1
             fi
             ;;
+        --engine)
+            if [ -n "$2" ]; then
+                ENGINE="--engine $2"
+                shift
+            else
+                echo "Error: --engine requires threads or processes."
+                exit 1
+            fi
+            ;;
         --k)
             if [ -n "$2" ]; then
                 K_VALUE="--k $2"
@@ -105,6 +148,93 @@ while [[ "$#" -gt 0 ]]; do
                 exit 1
             fi
             ;;
+        --band)
+            if [ -n "$2" ]; then
+                BAND_VALUE="--band $2"
+                shift
+            else
+                echo "Error: --band requires a number."
+                exit 1
+            fi
+            ;;
+        --align-mode)
+            if [ -n "$2" ]; then
+                ALIGN_MODE="--align-mode $2"
+                shift
+            else
+                echo "Error: --align-mode requires region or chain."
+                exit 1
+            fi
+            ;;
+        --max-band-cells)
+            if [ -n "$2" ]; then
+                MAX_BAND_CELLS="--max-band-cells $2"
+                shift
+            else
+                echo "Error: --max-band-cells requires a number."
+                exit 1
+            fi
+            ;;
+        --min-chain-score|--max-chains|--x-drop|--max-occurrences|--min-anchors|--min-anchor-density|--min-chain-coverage)
+            if [ -n "$2" ]; then
+                CHAIN_FLAGS="$CHAIN_FLAGS $1 $2"
+                shift
+            else
+                echo "Error: $1 requires a number."
+                exit 1
+            fi
+            ;;
+        --sample|--seed)
+            if [ -n "$2" ]; then
+                SCHEDULE_FLAGS="$SCHEDULE_FLAGS $1 $2"
+                shift
+            else
+                echo "Error: $1 requires a number."
+                exit 1
+            fi
+            ;;
+        --ordered)
+            SCHEDULE_FLAGS="$SCHEDULE_FLAGS --ordered"
+            ;;
+        --index-dir)
+            if [ -n "$2" ]; then
+                INDEX_DIR="--index-dir $2"
+                shift
+            else
+                echo "Error: --index-dir requires a directory path."
+                exit 1
+            fi
+            ;;
+        --rebuild-index)
+            INDEX_FLAGS="$INDEX_FLAGS --rebuild-index"
+            ;;
+        --build-index)
+            INDEX_FLAGS="$INDEX_FLAGS --build-index"
+            ;;
+        --serve)
+            SERVE_FLAGS="$SERVE_FLAGS --serve"
+            ;;
+        --socket|--port)
+            if [ -n "$2" ]; then
+                SERVE_FLAGS="$SERVE_FLAGS $1 $2"
+                shift
+            else
+                echo "Error: $1 requires a value."
+                exit 1
+            fi
+            ;;
+        --plot)
+            if [ -n "$2" ]; then
+                PLOT_FLAG="--plot $2"
+                shift
+            else
+                echo "Error: --plot requires coverage, reads or none."
+                exit 1
+            fi
+            ;;
+        --profile|--trace-memory)
+            PROFILE_FLAGS="$PROFILE_FLAGS $1"
+            ;;
         --debug)
             DEBUG_MODE="--debug"
             ;;
@@ -117,12 +247,17 @@ while [[ "$#" -gt 0 ]]; do
     shift
 done
 
-# Check if both required arguments are provided
-if [ -z "$REFERENCE_FILE" ] || [ -z "$FRAGMENTS_FILE" ]; then
+# Check if both required arguments are provided (no fragments file when serving or only building the index)
+if [ -z "$REFERENCE_FILE" ] || { [ -z "$FRAGMENTS_FILE" ] && [ -z "$SERVE_FLAGS$INDEX_FLAGS" ]; }; then
     echo "Error: --reference and --fragments are required."
     display_help
     exit 1
 fi
 
+FRAGMENTS_ARG=()
+if [ -n "$FRAGMENTS_FILE" ]; then
+    FRAGMENTS_ARG=(--fragments "$FRAGMENTS_FILE")
+fi
+
 # Run the Python script with the provided files and parameters
-python3 ./src/main.py --reference "$REFERENCE_FILE" --fragments "$FRAGMENTS_FILE" $CIGAR_FLAG $THREADS $K_VALUE $W_VALUE $F_VALUE $DEBUG_MODE
\ No newline at end of file
+python3 ./src/main.py --reference "$REFERENCE_FILE" "${FRAGMENTS_ARG[@]}" $CIGAR_FLAG $THREADS $ENGINE $K_VALUE $W_VALUE $F_VALUE $BAND_VALUE $ALIGN_MODE $MAX_BAND_CELLS $CHAIN_FLAGS $SCHEDULE_FLAGS $INDEX_DIR $INDEX_FLAGS $SERVE_FLAGS $PLOT_FLAG $PROFILE_FLAGS $DEBUG_MODE
\ No newline at end of file
@@ -1,8 +1,97 @@
 import numpy as np
+import metrics
+from sequence import CODE_BASES, encode_sequence
+
+# Traceback ops, one per alignment column: 0 diagonal (seq1 and seq2 base), 1 up (seq1
+# base, gap in seq2), 2 left (gap in seq1, seq2 base)
+GAP = ord('-')
+# CIGAR letters by column class, seq1 being the query: 0 match, 1 mismatch, 2 up, 3 left
+CIGAR_OPS = np.array(list('=XID'))
+
+def trace_step(direction, i, j, trace):
+  trace.append(direction)
+  if direction == 0:
+    return i - 1, j - 1
+  if direction == 1:
+    return i - 1, j
+  return i, j - 1
+
+def run_lengths(values):
+  # (value, length) of each run of equal consecutive values
+  if len(values) == 0:
+    return values[:0], np.empty(0, dtype=np.int64)
+  starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+  return values[starts], np.diff(np.append(starts, len(values)))
+
+class Alignment:
+  # Run-length encoded traceback of seq1[begin1:end1] against seq2[begin2:end2]. Only the
+  # aligned parts of both sequences are kept (as base codes), gapped strings are rendered on
+  # demand. clips are the unaligned seq1 bases before and after, written as soft clips in the CIGAR.
+  def __init__(self, seq1, seq2, ops, lengths, begin1=0, begin2=0, clips=(0, 0)):
+    self.seq1, self.seq2 = encode_sequence(seq1), encode_sequence(seq2)
+    self.ops = np.asarray(ops, dtype=np.int8)
+    self.lengths = np.asarray(lengths, dtype=np.int64)
+    self.begin1, self.begin2 = begin1, begin2
+    self.clips = clips
+
+  @classmethod
+  def from_trace(cls, seq1, seq2, trace, begin1, begin2):
+    # trace holds one op per column from the end of the alignment back to (begin1, begin2)
+    ops, lengths = run_lengths(np.array(trace[::-1], dtype=np.int8))
+    end1 = begin1 + int(lengths[ops != 2].sum())
+    end2 = begin2 + int(lengths[ops != 1].sum())
+    return cls(seq1[begin1:end1], seq2[begin2:end2], ops, lengths, int(begin1), int(begin2))
+
+  @property
+  def end1(self):
+    return self.begin1 + len(self.seq1)
+
+  @property
+  def end2(self):
+    return self.begin2 + len(self.seq2)
+
+  def __len__(self):
+    return int(self.lengths.sum())
+
+  def columns(self):
+    return np.repeat(self.ops, self.lengths)
+
+  def render(self):
+    # (aligned_seq1, aligned_seq2) with '-' for gaps, non-ACGT bases are shown as N
+    columns = self.columns()
+    aligned_seq1 = np.full(len(columns), GAP, dtype=np.uint8)
+    aligned_seq2 = np.full(len(columns), GAP, dtype=np.uint8)
+    aligned_seq1[columns != 2] = CODE_BASES[self.seq1]
+    aligned_seq2[columns != 1] = CODE_BASES[self.seq2]
+    return aligned_seq1.tobytes().decode('ascii'), aligned_seq2.tobytes().decode('ascii')
+
+  def summary(self):
+    # (residue matches, block length, CIGAR) from one expansion of the runs. Diagonal runs
+    # are split into = and X by comparing the bases they cover.
+    columns = self.columns()
+    if len(columns) == 0:
+      return 0, 0, ''
+    clip_begin, clip_end = self.clips
+    diagonal = columns == 0
+    i = np.cumsum(columns != 2) - 1
+    j = np.cumsum(columns != 1) - 1
+    classes = columns.astype(np.int8) + 1
+    classes[diagonal] = self.seq1[i[diagonal]] != self.seq2[j[diagonal]]
+    values, lengths = run_lengths(classes)
+    cigar = ''.join(np.char.add(lengths.astype(str), CIGAR_OPS[values]))
+    if clip_begin:
+      cigar = f'{clip_begin}S{cigar}'
+    if clip_end:
+      cigar = f'{cigar}{clip_end}S'
+    return int(np.count_nonzero(classes == 0)), len(columns), cigar
+
+  def cigar(self):
+    return self.summary()[2]
 
 # Global Alignment - Needleman-Wunsch
 def needleman_wunsch(seq1, seq2, match=1, mismatch=-1, gap=-2):
   m, n = len(seq1), len(seq2)
+  a, b = encode_sequence(seq1).tolist(), encode_sequence(seq2).tolist()
   score_matrix = np.zeros((m+1, n+1))
   traceback_matrix = np.zeros((m+1, n+1), dtype=np.int8)
   
@@ -16,36 +105,121 @@ def needleman_wunsch(seq1, seq2, match=1, mismatch=-1, gap=-2):
   
   for i in range(1, m+1):
     for j in range(1, n+1):
-      match_score = score_matrix[i-1][j-1] + (match if seq1[i-1] == seq2[j-1] else mismatch)
+      match_score = score_matrix[i-1][j-1] + (match if a[i-1] == b[j-1] else mismatch)
       delete = score_matrix[i-1][j] + gap
       insert = score_matrix[i][j-1] + gap
       score_matrix[i][j], traceback_matrix[i][j] = max((match_score, 0), (delete, 1), (insert, 2))
+  metrics.count('dp_cells', m * n)
   
   # Traceback
-  aligned_seq1, aligned_seq2 = '', ''
+  trace = []
   i, j = m, n
   while i > 0 or j > 0:
-    if traceback_matrix[i][j] == 0:
-      aligned_seq1 = seq1[i-1] + aligned_seq1
-      aligned_seq2 = seq2[j-1] + aligned_seq2
-      i -= 1
-      j -= 1
-    elif traceback_matrix[i][j] == 1:
-      aligned_seq1 = seq1[i-1] + aligned_seq1
-      aligned_seq2 = '-' + aligned_seq2
-      i -= 1
-    else:
-      aligned_seq1 = '-' + aligned_seq1
-      aligned_seq2 = seq2[j-1] + aligned_seq2
-      j -= 1
+    i, j = trace_step(traceback_matrix[i][j], i, j, trace)
   
   alignment_score = score_matrix[m][n]
-  return score_matrix, aligned_seq1, aligned_seq2, alignment_score,''
+  return score_matrix, Alignment.from_trace(seq1, seq2, trace, i, j), alignment_score
+
+
+# Banded Global Alignment - Needleman-Wunsch restricted to a band around the diagonal
+NEG_INF = -(1 << 30)
+
+def band_width(m, n, band=None, min_band=32, band_fraction=0.1):
+  # Adaptive half-width: a fraction of the longer sequence, never narrower than the
+  # diagonal slope so consecutive rows of the band always overlap
+  if band is None:
+    band = max(min_band, int(band_fraction * max(m, n)))
+  return max(band, -(-n // max(m, 1)) + 1)
+
+def band_limits(m, n, band=None):
+  # First and last column of the band in each row, within band of the line from (0, 0) to (m, n)
+  band = band_width(m, n, band)
+  centers = (np.arange(m + 1, dtype=np.int64) * n) // max(m, 1)
+  return np.maximum(centers - band, 0), np.minimum(centers + band, n), 2 * band + 1
+
+def banded_rows(a, b, lows, highs, row, r0, r1, match, mismatch, gap):
+  # Yields (i, row, codes) for rows r0+1..r1 of the band, given the row r0 values. Each row
+  # is filled with int32 vector ops, insertions via a running maximum.
+  for i in range(r0 + 1, r1 + 1):
+    prev_row, prev_low, prev_high = row, lows[i-1], highs[i-1]
+    cols = np.arange(lows[i], highs[i] + 1)
+
+    up = np.full(len(cols), NEG_INF, dtype=np.int32)
+    in_band = cols <= prev_high
+    up[in_band] = prev_row[cols[in_band] - prev_low] + gap
+
+    diag = np.full(len(cols), NEG_INF, dtype=np.int32)
+    in_band = (cols >= prev_low + 1) & (cols <= prev_high + 1)
+    diag_cols = cols[in_band]
+    diag[in_band] = prev_row[diag_cols - 1 - prev_low] + np.where(b[diag_cols - 1] == a[i-1], match, mismatch)
+
+    best = np.maximum(diag, up)
+    # H[j] = max(best[j], H[j-1] + gap) as a prefix maximum of best[l] - l * gap
+    row = (np.maximum.accumulate(best - cols * gap) + cols * gap).astype(np.int32)
+
+    insert = np.full(len(cols), NEG_INF, dtype=np.int32)
+    insert[1:] = row[:-1] + gap
+    yield i, row, np.where(insert >= best, 2, np.where(up >= diag, 1, 0)).astype(np.int8)
+
+def banded_needleman_wunsch(seq1, seq2, match=1, mismatch=-1, gap=-2, band=None):
+  # Same scoring and tie-breaking as needleman_wunsch, but only cells within band of the
+  # line from (0, 0) to (m, n) are computed, and only the int8 traceback band is kept.
+  m, n = len(seq1), len(seq2)
+  a, b = encode_sequence(seq1), encode_sequence(seq2)
+  lows, highs, width = band_limits(m, n, band)
+  traceback_band = np.zeros((m + 1, width), dtype=np.int8)
+
+  row = (np.arange(lows[0], highs[0] + 1) * gap).astype(np.int32)
+  traceback_band[0, :len(row)] = 2
+  for i, row, codes in banded_rows(a, b, lows, highs, row, 0, m, match, mismatch, gap):
+    traceback_band[i, :len(codes)] = codes
+
+  metrics.count('dp_cells', int((highs - lows + 1).sum()))
+
+  # Traceback
+  trace = []
+  i, j = m, n
+  while i > 0 or j > 0:
+    i, j = trace_step(traceback_band[i, j - lows[i]], i, j, trace)
+
+  alignment_score = int(row[n - lows[m]])
+  return None, Alignment.from_trace(a, b, trace, i, j), alignment_score
+
+def checkpointed_banded_needleman_wunsch(seq1, seq2, match=1, mismatch=-1, gap=-2, band=None):
+  # banded_needleman_wunsch without the full traceback band: the forward pass keeps every
+  # step-th row, the traceback recomputes the rows below one checkpoint at a time. Same
+  # cells and tie-breaking (so the same alignment) for twice the work, in O(sqrt(m) * band)
+  # memory instead of O(m * band).
+  m, n = len(seq1), len(seq2)
+  a, b = encode_sequence(seq1), encode_sequence(seq2)
+  lows, highs, _ = band_limits(m, n, band)
+  step = max(1, int(np.sqrt(m)))
+
+  row = (np.arange(lows[0], highs[0] + 1) * gap).astype(np.int32)
+  checkpoints = {0: row}
+  for i, row, _ in banded_rows(a, b, lows, highs, row, 0, m, match, mismatch, gap):
+    if i % step == 0:
+      checkpoints[i] = row
+  alignment_score = int(row[n - lows[m]])
+
+  # Traceback, one block of rows at a time from the bottom
+  trace = []
+  i, j = m, n
+  while i > 0:
+    r0 = (i - 1) // step * step
+    codes = [row_codes for _, _, row_codes in banded_rows(a, b, lows, highs, checkpoints[r0], r0, i, match, mismatch, gap)]
+    while i > r0:
+      i, j = trace_step(codes[i - r0 - 1][j - lows[i]], i, j, trace)
+  trace.extend([2] * j)
+
+  metrics.count('dp_cells', 2 * int((highs - lows + 1).sum()))
+  return None, Alignment.from_trace(a, b, trace, 0, 0), alignment_score
 
 
 # Local Alignment - Smith-Waterman
 def smith_waterman(seq1, seq2, match=1, mismatch=-1, gap=-1):
   m, n = len(seq1), len(seq2)
+  a, b = encode_sequence(seq1).tolist(), encode_sequence(seq2).tolist()
   score_matrix = np.zeros((m+1, n+1))
   traceback_matrix = np.zeros((m+1, n+1), dtype=np.int8)
   
@@ -54,39 +228,29 @@ def smith_waterman(seq1, seq2, match=1, mismatch=-1, gap=-1):
   
   for i in range(1, m+1):
     for j in range(1, n+1):
-      match_score = score_matrix[i-1][j-1] + (match if seq1[i-1] == seq2[j-1] else mismatch)
+      match_score = score_matrix[i-1][j-1] + (match if a[i-1] == b[j-1] else mismatch)
       delete = score_matrix[i-1][j] + gap
       insert = score_matrix[i][j-1] + gap
       score_matrix[i][j], traceback_matrix[i][j] = max((0, -1), (match_score, 0), (delete, 1), (insert, 2))
       if score_matrix[i][j] >= max_score:
           max_score = score_matrix[i][j]
           max_i, max_j = i, j
+  metrics.count('dp_cells', m * n)
   
   # Traceback
-  aligned_seq1, aligned_seq2 = '', ''
+  trace = []
   i, j = max_i, max_j
   while i > 0 and j > 0 and score_matrix[i][j] > 0:
-    if traceback_matrix[i][j] == 0:
-      aligned_seq1 = seq1[i-1] + aligned_seq1
-      aligned_seq2 = seq2[j-1] + aligned_seq2
-      i -= 1
-      j -= 1
-    elif traceback_matrix[i][j] == 1:
-      aligned_seq1 = seq1[i-1] + aligned_seq1
-      aligned_seq2 = '-' + aligned_seq2
-      i -= 1
-    else:
-      aligned_seq1 = '-' + aligned_seq1
-      aligned_seq2 = seq2[j-1] + aligned_seq2
-      j -= 1
+    i, j = trace_step(traceback_matrix[i][j], i, j, trace)
   
   alignment_score = max_score
-  return score_matrix, aligned_seq1, aligned_seq2, alignment_score,''
+  return score_matrix, Alignment.from_trace(seq1, seq2, trace, i, j), alignment_score
 
 
 # Semi-Global Alignment
 def semi_global(seq1, seq2, match=1, mismatch=-1, gap=-1):
   m, n = len(seq1), len(seq2)
+  a, b = encode_sequence(seq1).tolist(), encode_sequence(seq2).tolist()
   score_matrix = np.zeros((m+1, n+1))
   traceback_matrix = np.zeros((m+1, n+1), dtype=np.int8)
   
@@ -99,32 +263,374 @@ def semi_global(seq1, seq2, match=1, mismatch=-1, gap=-1):
   
   for i in range(1, m+1):
     for j in range(1, n+1):
-      match_score = score_matrix[i-1][j-1] + (match if seq1[i-1] == seq2[j-1] else mismatch)
+      match_score = score_matrix[i-1][j-1] + (match if a[i-1] == b[j-1] else mismatch)
       delete = score_matrix[i-1][j] + gap
       insert = score_matrix[i][j-1] + gap
       score_matrix[i][j], traceback_matrix[i][j] = max((match_score, 0), (delete, 1), (insert, 2))
+  metrics.count('dp_cells', m * n)
   
   # Traceback
-  aligned_seq1, aligned_seq2 = '', ''
+  trace = []
   
-  i, j = m, np.argmax(score_matrix[m]) if np.max(score_matrix[m]) > np.max(score_matrix[:, n]) else np.argmax(score_matrix[:, n])
+  # The alignment ends in the last row or, on ties, in the last column
+  if np.max(score_matrix[m]) > np.max(score_matrix[:, n]):
+    i, j = m, int(np.argmax(score_matrix[m]))
+  else:
+    i, j = int(np.argmax(score_matrix[:, n])), n
   while i > 0 or j > 0:
-    if traceback_matrix[i][j] == 0:
-      aligned_seq1 = seq1[i-1] + aligned_seq1
-      aligned_seq2 = seq2[j-1] + aligned_seq2
-      i -= 1
-      j -= 1
-    elif traceback_matrix[i][j] == 1:
-      aligned_seq1 = seq1[i-1] + aligned_seq1
-      aligned_seq2 = '-' + aligned_seq2
-      i -= 1
-    else:
-      aligned_seq1 = '-' + aligned_seq1
-      aligned_seq2 = seq2[j-1] + aligned_seq2
-      j -= 1
+    i, j = trace_step(traceback_matrix[i][j], i, j, trace)
   
   alignment_score = max(np.max(score_matrix[m]), np.max(score_matrix[:, n]))
-  return score_matrix, aligned_seq1, aligned_seq2, alignment_score,''
+  return score_matrix, Alignment.from_trace(seq1, seq2, trace, i, j), alignment_score
+
+
+# Linear-space (Hirschberg-style) variants of the three aligners above. They keep only a
+# couple of DP rows at a time and split the matrix at its middle row. Instead of the classic
+# forward/backward score split, every cell below the middle row carries the column where
+# its traceback path first reaches the middle row, so the path recovered is exactly the one
+# the full-matrix traceback would follow (same tie-breaking, same alignment).
+LINEAR_SPACE_BASE_CELLS = 1 << 16
+
+def linear_space_row(mode, prev_row, prev_left, left, a_code, b_codes, has_col0, col0_value, match, mismatch, gap):
+  # One DP row over columns c0..c1. prev_left/left are the column c0-1 values of the
+  # previous/current row (None when c0 == 0, column 0 is then forced to col0_value).
+  floor = 0 if mode == 'local' else NEG_INF
+  substitution = np.where(b_codes == a_code, match, mismatch)
+
+  diag = np.empty(len(prev_row), dtype=np.int64)
+  diag[1:] = prev_row[:-1] + substitution[1:]
+  diag[0] = prev_left + substitution[0] if prev_left is not None else NEG_INF
+  up = prev_row + gap
+  best = np.maximum(np.maximum(diag, up), floor)
+  if has_col0:
+    best[0] = col0_value
+  elif left is not None:
+    best[0] = max(best[0], left + gap)
+
+  cols = np.arange(len(best), dtype=np.int64)
+  row = np.maximum.accumulate(best - cols * gap) + cols * gap
+
+  insert = np.empty(len(row), dtype=np.int64)
+  insert[1:] = row[:-1] + gap
+  insert[0] = left + gap if left is not None else NEG_INF
+  codes = np.where(insert >= best, 2, np.where(up >= np.maximum(diag, floor), 1, np.where(diag >= floor, 0, -1)))
+  if has_col0:
+    codes[0] = -1 if mode == 'local' else 1
+  return row, codes.astype(np.int8)
+
+def linear_space_rows(mode, a, b, r0, r1, c0, c1, top, left, scoring, col0):
+  # Yields (i, row, codes) for rows r0+1..r1 of the rectangle, given the row r0 values
+  # and the column c0-1 values for rows r0..r1
+  has_col0 = c0 == 0
+  b_codes = b[max(c0 - 1, 0):c1]
+  if has_col0:
+    b_codes = np.concatenate(([0], b_codes))
+  row = top
+  for i in range(r0 + 1, r1 + 1):
+    prev_left = left[i - r0 - 1] if left is not None else None
+    current_left = left[i - r0] if left is not None else None
+    row, codes = linear_space_row(mode, row, prev_left, current_left, a[i-1], b_codes, has_col0, col0(i), *scoring)
+    metrics.count('dp_cells', len(row))
+    yield i, row, codes
+
+def linear_space_trace(mode, a, b, r0, r1, c0, c1, top, left, scoring, col0, ops):
+  # Appends the traceback ops (0 diagonal, 1 up, 2 left) from (r1, c1) until the path first
+  # reaches row r0, and returns the column where it does
+  if r1 - r0 <= 1 or (r1 - r0) * (c1 - c0 + 1) <= LINEAR_SPACE_BASE_CELLS:
+    codes = [row_codes for _, _, row_codes in linear_space_rows(mode, a, b, r0, r1, c0, c1, top, left, scoring, col0)]
+    i, j = r1, c1
+    while i > r0:
+      direction = codes[i - r0 - 1][j - c0]
+      ops.append(direction)
+      if direction == 0:
+        i -= 1
+        j -= 1
+      elif direction == 1:
+        i -= 1
+      else:
+        j -= 1
+    return j
+
+  mid = (r0 + r1) // 2
+  rows = linear_space_rows(mode, a, b, r0, r1, c0, c1, top, left, scoring, col0)
+  for i, row, codes in rows:
+    if i == mid:
+      break
+  mid_row = row
+
+  # Column where each cell's path first reaches row mid (-1 if it leaves the rectangle)
+  cross = np.arange(c0, c1 + 1)
+  positions = np.arange(len(cross))
+  for i, row, codes in rows:
+    base = np.full(len(cross), -1)
+    base[1:] = np.where(codes[1:] == 0, cross[:-1], -1)
+    base = np.where(codes == 1, cross, base)
+    last = np.maximum.accumulate(np.where(codes != 2, positions, -1))
+    cross = np.where(last >= 0, base[np.maximum(last, 0)], -1)
+  c = int(cross[-1])
+
+  if c == c0:
+    lower_left = left[mid - r0:] if left is not None else None
+  else:
+    # Column c-1 of the lower half is needed as its left boundary
+    lower_left = [mid_row[c - 1 - c0]]
+    left_part = left[mid - r0:] if left is not None else None
+    for _, row, _ in linear_space_rows(mode, a, b, mid, r1, c0, c - 1, mid_row[:c - c0], left_part, scoring, col0):
+      lower_left.append(row[-1])
+  linear_space_trace(mode, a, b, mid, r1, c, c1, mid_row[c - c0:], lower_left, scoring, col0, ops)
+
+  upper_left = left[:mid - r0 + 1] if left is not None else None
+  return linear_space_trace(mode, a, b, r0, mid, c0, c, top[:c - c0 + 1], upper_left, scoring, col0, ops)
+
+def hirschberg_needleman_wunsch(seq1, seq2, match=1, mismatch=-1, gap=-2):
+  m, n = len(seq1), len(seq2)
+  a, b = encode_sequence(seq1), encode_sequence(seq2)
+  scoring = (match, mismatch, gap)
+  col0 = lambda i: i * gap
+  top = np.arange(n + 1, dtype=np.int64) * gap
+
+  row = top
+  for _, row, _ in linear_space_rows('global', a, b, 0, m, 0, n, top, None, scoring, col0):
+    pass
+  alignment_score = int(row[n])
+
+  ops = []
+  j = linear_space_trace('global', a, b, 0, m, 0, n, top, None, scoring, col0, ops) if m > 0 else n
+  ops.extend([2] * j)
+  return None, Alignment.from_trace(a, b, ops, 0, 0), alignment_score
+
+def hirschberg_semi_global(seq1, seq2, match=1, mismatch=-1, gap=-1):
+  m, n = len(seq1), len(seq2)
+  a, b = encode_sequence(seq1), encode_sequence(seq2)
+  scoring = (match, mismatch, gap)
+  col0 = lambda i: 0
+  top = np.zeros(n + 1, dtype=np.int64)
+
+  row = top
+  last_col = [0]
+  for _, row, _ in linear_space_rows('semi_global', a, b, 0, m, 0, n, top, None, scoring, col0):
+    last_col.append(row[n])
+  last_col = np.array(last_col)
+
+  # Same end cell selection as semi_global
+  if np.max(row) > np.max(last_col):
+    i, j = m, int(np.argmax(row))
+  else:
+    i, j = int(np.argmax(last_col)), n
+  alignment_score = int(max(np.max(row), np.max(last_col)))
+
+  ops = []
+  if i > 0:
+    j = linear_space_trace('semi_global', a, b, 0, i, 0, j, top[:j + 1], None, scoring, col0, ops)
+  ops.extend([2] * j)
+  return None, Alignment.from_trace(a, b, ops, 0, 0), alignment_score
+
+def hirschberg_smith_waterman(seq1, seq2, match=1, mismatch=-1, gap=-1):
+  m, n = len(seq1), len(seq2)
+  a, b = encode_sequence(seq1), encode_sequence(seq2)
+  scoring = (match, mismatch, gap)
+  col0 = lambda i: 0
+  top = np.zeros(n + 1, dtype=np.int64)
+
+  # First pass: best cell (last one in row-major order, as in smith_waterman) and the cell
+  # where its traceback stops, found by carrying each cell's start as a flat index
+  max_score, max_i, max_j = 0, 0, 0
+  positions = np.arange(n + 1)
+  origin = positions.copy()
+  end_origin = 0
+  for i, row, codes in linear_space_rows('local', a, b, 0, m, 0, n, top, None, scoring, col0):
+    own = i * (n + 1) + positions
+    base = np.where(codes == 1, origin, own)
+    base[1:] = np.where(codes[1:] == 0, origin[:-1], base[1:])
+    base[(row <= 0) | (positions == 0)] = own[(row <= 0) | (positions == 0)]
+    stops = (codes != 2) | (row <= 0) | (positions == 0)
+    last = np.maximum.accumulate(np.where(stops, positions, 0))
+    origin = base[last]
+
+    row_max = row[1:].max() if n > 0 else 0
+    if n > 0 and row_max >= max_score:
+      max_score, max_i = row_max, i
+      max_j = n - int(np.argmax(row[:0:-1] == row_max))
+      end_origin = int(origin[max_j])
+  if m == 0 or n == 0:
+    max_i, max_j, end_origin = 0, 0, 0
+  start_i, start_j = divmod(end_origin, n + 1)
+
+  if (start_i, start_j) == (max_i, max_j):
+    return None, Alignment.from_trace(a, b, [], max_i, max_j), int(max_score)
+
+  # Second pass: boundary values of the rectangle the alignment lies in
+  start_row = top[start_j:max_j + 1]
+  left = [0] if start_j > 0 and start_i == 0 else None
+  for i, row, _ in linear_space_rows('local', a, b, 0, max_i, 0, max_j, top[:max_j + 1], None, scoring, col0):
+    if i == start_i:
+      start_row = row[start_j:]
+      left = [row[start_j - 1]] if start_j > 0 else None
+    elif i > start_i and left is not None:
+      left.append(row[start_j - 1])
+
+  ops = []
+  j = linear_space_trace('local', a, b, start_i, max_i, start_j, max_j, start_row, left, scoring, col0, ops)
+  ops.extend([2] * (j - start_j))
+  return None, Alignment.from_trace(a, b, ops, start_i, start_j), int(max_score)
+
+
+# Gapped X-drop extension: global at (0, 0), free at the other end. Each row only keeps the
+# cells scoring at least best - x_drop, and the extension stops at the first row with none
+# left, so the work done past the end of the true alignment is bounded by x_drop.
+# Returns (score, Alignment) of the best-scoring prefix of seq1 against a prefix of seq2.
+def xdrop_extend(seq1, seq2, match=1, mismatch=-1, gap=-2, x_drop=40):
+  m, n = len(seq1), len(seq2)
+  a, b = encode_sequence(seq1), encode_sequence(seq2)
+
+  # Row 0: leading gaps while they stay within x_drop of the empty alignment
+  low = 0
+  row = np.arange(min(n, x_drop // -gap) + 1, dtype=np.int64) * gap
+  row_codes = [(0, np.full(len(row), 2, dtype=np.int8))]
+  best_score, best_i, best_j = 0, 0, 0
+  cells = len(row)
+
+  for i in range(1, m + 1):
+    prev_low, prev_row = low, row
+    cols = np.arange(prev_low, min(prev_low + len(prev_row), n) + 1)
+    up = np.full(len(cols), NEG_INF, dtype=np.int64)
+    up[:len(prev_row)] = prev_row + gap
+    diag = np.full(len(cols), NEG_INF, dtype=np.int64)
+    diag_cols = cols[1:]
+    diag[1:] = prev_row[:len(diag_cols)] + np.where(b[diag_cols - 1] == a[i-1], match, mismatch)
+
+    best = np.maximum(diag, up)
+    offsets = np.arange(len(cols), dtype=np.int64)
+    row = np.maximum.accumulate(best - offsets * gap) + offsets * gap
+    insert = np.full(len(cols), NEG_INF, dtype=np.int64)
+    insert[1:] = row[:-1] + gap
+    codes = np.where(insert >= best, 2, np.where(up >= diag, 1, 0)).astype(np.int8)
+
+    # Horizontal gaps can run past the previous row's last live column
+    tail = min(n - cols[-1], max(0, int(row[-1] - (best_score - x_drop)) // -gap))
+    if tail > 0:
+      row = np.concatenate((row, row[-1] + np.arange(1, tail + 1, dtype=np.int64) * gap))
+      codes = np.concatenate((codes, np.full(tail, 2, dtype=np.int8)))
+
+    cells += len(row)
+    row_best = int(np.argmax(row))
+    if row[row_best] > best_score:
+      best_score, best_i, best_j = int(row[row_best]), i, low + row_best
+
+    live = np.flatnonzero(row >= best_score - x_drop)
+    if len(live) == 0:
+      break
+    row_codes.append((low, codes))
+    low, row = low + live[0], np.where(row[live[0]:live[-1] + 1] >= best_score - x_drop, row[live[0]:live[-1] + 1], NEG_INF)
+
+  metrics.count('dp_cells', cells)
+
+  trace = []
+  i, j = best_i, best_j
+  while i > 0 or j > 0:
+    row_low, codes = row_codes[i]
+    i, j = trace_step(codes[j - row_low], i, j, trace)
+  return best_score, Alignment.from_trace(a, b, trace, 0, 0)
+
+
+# Batched local / semi-global scoring. All pairs are padded into 2-D uint8 arrays and the DP
+# advances one row at a time for the whole batch, so the interpreter cost of a row is shared
+# by every pair. Cells outside a pair's own (m, n) rectangle are computed but never read:
+# they only depend on cells further up or left, never the other way round.
+def pad_sequences(sequences):
+  codes = [encode_sequence(seq) for seq in sequences]
+  lengths = np.array([len(c) for c in codes], dtype=np.int64)
+  padded = np.zeros((len(codes), max(lengths, default=0)), dtype=np.uint8)
+  for row, c in zip(padded, codes):
+    row[:len(c)] = c
+  return padded, lengths
+
+def batch_align(pairs, mode='local', match=1, mismatch=-1, gap=-1, traceback_threshold=None):
+  # Scores many (query, target) pairs at once with smith_waterman ('local') or semi_global
+  # ('semi_global') scoring. Returns (scores, ends, alignments): ends holds the (i, j) cell
+  # each best alignment ends in, alignments an Alignment for every pair scoring at least
+  # traceback_threshold and None for the rest (all None when no threshold is given).
+  if mode not in ('local', 'semi_global'):
+    raise ValueError(f'Unknown batch alignment mode: {mode}')
+  queries, m = pad_sequences([query for query, _ in pairs])
+  targets, n = pad_sequences([target for _, target in pairs])
+  batch, max_m, max_n = len(pairs), queries.shape[1], targets.shape[1]
+  batch_index = np.arange(batch)
+  cols = np.arange(max_n + 1, dtype=np.int32)
+  in_target = cols[None, :] <= n[:, None]
+
+  # Traceback codes as in linear_space_row (-1 where a local alignment starts), only kept
+  # when some alignments are wanted: one byte per cell of the padded batch
+  codes = None
+  if traceback_threshold is not None:
+    codes = np.empty((batch, max_m + 1, max_n + 1), dtype=np.int8)
+    codes[:, 0, :] = -1 if mode == 'local' else 2
+    codes[:, :, 0] = -1 if mode == 'local' else 1
+
+  row = np.zeros((batch, max_n + 1), dtype=np.int32)
+  scores = np.zeros(batch, dtype=np.int64)
+  ends = np.zeros((batch, 2), dtype=np.int64)
+  if mode == 'local':
+    ends[:] = np.where(((m > 0) & (n > 0))[:, None], np.stack((m, n), axis=1), 0)
+  else:
+    # Semi-global ends in the last row or the last column, both start at 0 in row/column 0
+    last_row = np.zeros((batch, max_n + 1), dtype=np.int32)
+    last_col = np.full((batch, max_m + 1), NEG_INF, dtype=np.int32)
+    last_col[:, 0] = 0
+
+  for i in range(1, max_m + 1):
+    substitution = np.where(targets == queries[:, i-1:i], match, mismatch).astype(np.int32)
+    diag = np.full((batch, max_n + 1), NEG_INF, dtype=np.int32)
+    diag[:, 1:] = row[:, :-1] + substitution
+    up = row + gap
+    best = np.maximum(diag, up)
+    if mode == 'local':
+      best = np.maximum(best, 0)
+    best[:, 0] = 0
+    row = (np.maximum.accumulate(best - cols * gap, axis=1) + cols * gap).astype(np.int32)
+
+    if codes is not None:
+      insert = np.full((batch, max_n + 1), NEG_INF, dtype=np.int32)
+      insert[:, 1:] = row[:, :-1] + gap
+      row_codes = np.where(insert >= best, 2, np.where(up >= diag, 1, 0))
+      if mode == 'local':
+        row_codes[row <= 0] = -1
+      codes[:, i, 1:] = row_codes[:, 1:]
+
+    active = i <= m
+    if mode == 'local':
+      # Last cell in row-major order holding the maximum, as in smith_waterman
+      masked = np.where(in_target, row, NEG_INF)
+      masked[:, 0] = NEG_INF
+      row_max = masked.max(axis=1)
+      row_end = max_n - np.argmax(masked[:, ::-1] == row_max[:, None], axis=1)
+      update = active & (n > 0) & (row_max >= scores)
+      scores[update] = row_max[update]
+      ends[update] = np.stack((np.full(batch, i), row_end), axis=1)[update]
+    else:
+      last_col[active, i] = row[batch_index[active], n[active]]
+      done = m == i
+      last_row[done] = row[done]
+
+  metrics.count('dp_cells', batch * max_m * max_n)
+
+  if mode == 'semi_global':
+    masked_row = np.where(in_target, last_row, NEG_INF)
+    row_max, col_max = masked_row.max(axis=1), last_col.max(axis=1)
+    in_row = row_max > col_max
+    scores = np.maximum(row_max, col_max).astype(np.int64)
+    ends[:, 0] = np.where(in_row, m, np.argmax(last_col, axis=1))
+    ends[:, 1] = np.where(in_row, np.argmax(masked_row, axis=1), n)
+
+  alignments = [None] * batch
+  if codes is not None:
+    for b in np.flatnonzero(scores >= traceback_threshold):
+      trace = []
+      i, j = ends[b]
+      while (i > 0 or j > 0) and codes[b, i, j] != -1:
+        i, j = trace_step(codes[b, i, j], i, j, trace)
+      alignments[b] = Alignment.from_trace(pairs[b][0], pairs[b][1], trace, i, j)
+  return scores, ends, alignments
 
 
 # # Example sequences
@@ -0,0 +1,306 @@
+import argparse
+import datetime
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import mapping
+import metrics
+from main import process_fragment
+from metrics import timer
+from minimizers import find_minimizer_arrays
+from misc import set_debug
+from output import OutputWriter
+from parallel import map_fragments
+from reference import ContigTable
+from sequence import PackedSequence
+
+# Reproducible benchmarks on synthetic data. A reference with chosen size, GC content and
+# repeat content is generated from a seed, long reads are sampled from it with a nanopore-like
+# error profile and their true position in the name, then the whole pipeline is timed per stage
+# for every (size, k, w, threads) combination. Each combination runs in a fresh process so the
+# peak memory, its workers' included, belongs to it. Results are saved as JSON and two runs can
+# be compared.
+#
+# Usage:
+#   python benchmark.py run [--sizes 200000,1000000] [--kw 15:5,19:10] [--threads 1,4] [--out results.json]
+#   python benchmark.py simulate --size 1000000 --reads 500 --out-dir ../input/synthetic
+#   python benchmark.py compare old.json new.json
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+CONTIG = 'synthetic'
+
+def to_string(codes):
+  return BASES[codes].tobytes().decode('ascii')
+
+def synthetic_genome(length, gc=0.42, repeat_fraction=0.05, repeat_length=2000, repeat_families=10, repeat_divergence=0.01, seed=0):
+  # Returns 2-bit codes (A, C, G, T = 0..3). Repeats are copies of a few random families pasted
+  # over the background, each copy diverged by a small fraction of substitutions.
+  rng = np.random.default_rng(seed)
+  probabilities = [(1 - gc) / 2, gc / 2, gc / 2, (1 - gc) / 2]
+  genome = rng.choice(4, size=length, p=probabilities).astype(np.uint8)
+
+  repeat_length = min(repeat_length, length // 4)
+  copies = int(length * repeat_fraction) // repeat_length if repeat_length > 0 else 0
+  if copies:
+    families = rng.choice(4, size=(repeat_families, repeat_length), p=probabilities).astype(np.uint8)
+    for family, start in zip(rng.integers(0, repeat_families, copies), rng.integers(0, length - repeat_length, copies)):
+      copy = families[family].copy()
+      mutated = rng.random(repeat_length) < repeat_divergence
+      copy[mutated] = (copy[mutated] + rng.integers(1, 4, mutated.sum())) % 4
+      genome[start:start + repeat_length] = copy
+  return genome
+
+def add_errors(template, rng, error_rate):
+  # Nanopore-like profile: deletions and insertions about as common as substitutions,
+  # insertions mostly repeat the previous base (homopolymer runs)
+  u = rng.random(len(template))
+  substitution = u < error_rate * 0.4
+  deletion = (u >= error_rate * 0.4) & (u < error_rate * 0.75)
+  insertion = (u >= error_rate * 0.75) & (u < error_rate)
+
+  bases = template.copy()
+  bases[substitution] = (bases[substitution] + rng.integers(1, 4, substitution.sum())) % 4
+  repeats = 1 - deletion.astype(np.int64) + insertion
+  read = np.repeat(bases, repeats)
+  inserted = (np.cumsum(repeats) - 1)[insertion]
+  random_base = inserted[rng.random(len(inserted)) < 0.5]
+  read[random_base] = rng.integers(0, 4, len(random_base))
+  return read
+
+def simulate_reads(genome, count, mean_length=3000, min_length=500, error_rate=0.08, seed=1):
+  # Yields (name, sequence) with the truth in the name as read!contig!start!end!strand
+  # (the paftools mapeval convention). Lengths are log-normal, per-read error rates vary.
+  rng = np.random.default_rng(seed)
+  sigma = 0.5
+  lengths = rng.lognormal(np.log(mean_length) - sigma ** 2 / 2, sigma, count).astype(np.int64)
+  lengths = np.clip(lengths, min_length, len(genome))
+  for i, length in enumerate(lengths):
+    start = int(rng.integers(0, len(genome) - length + 1))
+    template = genome[start:start + length]
+    strand = '+' if rng.random() < 0.5 else '-'
+    if strand == '-':
+      template = 3 - template[::-1]
+    read_error_rate = float(np.clip(rng.normal(error_rate, error_rate / 4), 0, 0.5))
+    yield f'sim{i}!{CONTIG}!{start}!{start + length}!{strand}', to_string(add_errors(template, rng, read_error_rate))
+
+def parse_truth(name):
+  _, contig, start, end, strand = name.split('!')
+  return contig, int(start), int(end), strand
+
+def is_correct(name, result, min_overlap=0.1):
+  # Same contig and strand, and the mapped target interval covers at least min_overlap of the true one
+  contig, start, end, strand = parse_truth(name)
+  target, t_begin, t_end, mapped_strand = result[1], result[4], result[5], result[9]
+  if target != contig or (mapped_strand == 'original') != (strand == '+'):
+    return False
+  return min(end, t_end) - max(start, t_begin) >= min_overlap * (end - start)
+
+def write_fasta(path, records, line_width=80):
+  with open(path, 'w') as file:
+    for name, sequence in records:
+      file.write(f'>{name}\n')
+      for i in range(0, len(sequence), line_width):
+        file.write(sequence[i:i + line_width] + '\n')
+
+def process_pss_kb(pid):
+  # Proportional set size: pages shared between processes (the reference and index in shared
+  # memory, copy-on-write pages after fork) are split between them instead of counted by each
+  try:
+    with open(f'/proc/{pid}/smaps_rollup') as file:
+      for line in file:
+        if line.startswith('Pss:'):
+          return int(line.split()[1])
+  except OSError:
+    pass
+  return 0
+
+def child_pids(pid):
+  pids = []
+  for task in os.listdir(f'/proc/{pid}/task'):
+    try:
+      with open(f'/proc/{pid}/task/{task}/children') as file:
+        pids += file.read().split()
+    except OSError:
+      pass
+  return pids
+
+class PeakMemory:
+  # Peak of the memory of this process and its worker processes taken together, sampled every
+  # interval seconds from /proc. Where /proc has no PSS, the ru_maxrss of the process that
+  # peaked highest is all there is.
+  def __init__(self, interval=0.1):
+    self.interval = interval
+    self.peak_kb = 0
+    self.stop = threading.Event()
+    self.thread = threading.Thread(target=self.run, daemon=True)
+
+  def sample(self):
+    pid = os.getpid()
+    self.peak_kb = max(self.peak_kb, sum(process_pss_kb(process) for process in [pid] + child_pids(pid)))
+
+  def run(self):
+    while not self.stop.wait(self.interval):
+      self.sample()
+
+  def __enter__(self):
+    if os.path.exists('/proc/self/smaps_rollup'):
+      self.sample()
+      self.thread.start()
+    return self
+
+  def __exit__(self, *exc):
+    if self.thread.is_alive():
+      self.stop.set()
+      self.thread.join()
+      self.sample()
+
+  def peak_mb(self):
+    if self.peak_kb:
+      return round(self.peak_kb / 1024, 1)
+    # ru_maxrss is in KiB on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / 1024, 1)
+
+def run_config(config):
+  # One benchmark point, runs in its own process
+  set_debug(False)
+  genome = synthetic_genome(config['size'], config['gc'], config['repeat_fraction'], seed=config['seed'])
+  reads = list(simulate_reads(genome, config['reads'], config['read_length'], error_rate=config['error_rate'], seed=config['seed'] + 1))
+  reference_seq = PackedSequence.from_codes(genome)
+  contigs = ContigTable([CONTIG], [len(reference_seq)])
+  k, w, f = config['k'], config['w'], config['f']
+  metrics.drain()
+
+  # Memory is followed from the index build to the end of the mapping, workers included
+  with PeakMemory() as memory:
+    started = time.perf_counter()
+    del genome
+    with timer('find_minimizers'):
+      find_minimizer_arrays(reference_seq, k, w, canonical=True)
+    with timer('index'):
+      minimizer_index = mapping.create_minimizer_index(reference_seq, k, w, f, 'original', canonical=True)
+    index_seconds = time.perf_counter() - started
+
+    options = {'band': None, 'align_mode': config['align_mode'], 'max_band_cells': mapping.MAX_BAND_CELLS, 'min_chain_score': 40, 'max_chains': 5, 'x_drop': 40,
+               'max_occurrences': 200, 'min_anchors': 3, 'min_anchor_density': 1.0, 'min_chain_coverage': 0.05}
+    process_kwargs = {'num_of_fragments': len(reads), 'k': k, 'w': w, 'f': f, 'output_filename': None, 'contigs': contigs, **options}
+    items = ((index, name, read) for index, (name, read) in enumerate(reads))
+    mapped, correct = 0, 0
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory:
+      with OutputWriter(os.path.join(directory, 'report.txt'), os.path.join(directory, 'out.paf'), contigs, cigar=True) as writer:
+        for _, name, result, error in map_fragments(items, process_fragment, process_kwargs, reference_seq, minimizer_index, config['threads'], config['engine']):
+          if error is not None:
+            raise RuntimeError(f'{name}: {error}')
+          if result is None:
+            continue
+          mapped += 1
+          correct += is_correct(name, result)
+          writer.write_result(name, result)
+    mapping_seconds = time.perf_counter() - started
+
+  bases = sum(len(read) for _, read in reads)
+  summary = metrics.summary(index_seconds + mapping_seconds)
+  return {**config, 'index_seconds': round(index_seconds, 6), 'mapping_seconds': round(mapping_seconds, 6),
+          'reads_per_s': round(len(reads) / mapping_seconds, 3), 'bases_per_s': round(bases / mapping_seconds, 1),
+          'peak_rss_mb': memory.peak_mb(), 'mapped': mapped, 'correct': correct,
+          'precision': round(correct / mapped, 4) if mapped else None, 'recall': round(correct / len(reads), 4),
+          'stages': summary['stages'], 'counters': summary['counters']}
+
+def run_benchmarks(configs):
+  # Executor workers, unlike Pool workers, may start their own worker processes. The parent
+  # holds nothing but the imported modules, so a forked worker starts from a clean baseline.
+  for config in configs:
+    with ProcessPoolExecutor(max_workers=1) as executor:
+      yield executor.submit(run_config, config).result()
+
+def config_key(run):
+  # Runs are only compared with the same setup
+  return (run['size'], run['k'], run['w'], run['threads'], run['engine'], run['align_mode'], run['reads'], run['error_rate'])
+
+def compare(old, new):
+  # Prints new/old ratios for the benchmark points both files have
+  old_runs = {config_key(run): run for run in old['runs']}
+  print(f'{"size":>10} {"k":>3} {"w":>3} {"thr":>3} {"engine":>9} {"mode":>6}  {"reads/s":>19}  {"peak memory MB":>17}  {"recall":>13}  stages (new/old time)')
+  for run in new['runs']:
+    before = old_runs.get(config_key(run))
+    if before is None:
+      continue
+    stages = ' '.join(f'{stage}={seconds["seconds"] / before["stages"][stage]["seconds"]:.2f}x'
+                      for stage, seconds in run['stages'].items() if before['stages'].get(stage, {}).get('seconds'))
+    print(f'{run["size"]:>10} {run["k"]:>3} {run["w"]:>3} {run["threads"]:>3} {run["engine"]:>9} {run["align_mode"]:>6}  {before["reads_per_s"]:>8.1f} -> {run["reads_per_s"]:>8.1f}'
+          f'  {before["peak_rss_mb"]:>7.1f} -> {run["peak_rss_mb"]:>7.1f}  {before["recall"]:>5} -> {run["recall"]:>5}  {stages}')
+
+def int_list(text):
+  return [int(float(value)) for value in text.split(',')]
+
+def parse_arguments():
+  parser = argparse.ArgumentParser(description="Benchmark the mapper on synthetic genomes and simulated reads.")
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  run = commands.add_parser('run', help="Time every stage over a grid of sizes, k/w and thread counts.")
+  run.add_argument('--sizes', type=int_list, default=[200000, 1000000], help="Reference sizes, comma separated (default 200000,1000000).")
+  run.add_argument('--kw', default='15:5', help="k:w pairs, comma separated (default 15:5).")
+  run.add_argument('--threads', type=int_list, default=[1], help="Thread counts, comma separated (default 1).")
+  run.add_argument('--engine', choices=['threads', 'processes'], default='threads', help="Mapping engine (default threads).")
+  run.add_argument('--align-mode', choices=['region', 'chain'], default='chain', help="Alignment mode (default chain).")
+  run.add_argument('--f', type=float, default=0.001, help="Fraction of most frequent minimizers dropped (default 0.001).")
+  run.add_argument('--reads', type=int, default=200, help="Simulated reads per point (default 200).")
+  run.add_argument('--out', help="Results file (default ./output/benchmark_<time>.json).")
+
+  simulate = commands.add_parser('simulate', help="Write a synthetic reference and simulated reads as FASTA.")
+  simulate.add_argument('--size', type=lambda value: int(float(value)), default=1000000, help="Reference size (default 1000000).")
+  simulate.add_argument('--reads', type=int, default=500, help="Number of reads (default 500).")
+  simulate.add_argument('--out-dir', required=True, help="Directory for reference.fasta and reads.fasta.")
+
+  for command in (run, simulate):
+    command.add_argument('--gc', type=float, default=0.42, help="GC content (default 0.42).")
+    command.add_argument('--repeat-fraction', type=float, default=0.05, help="Fraction of the reference covered by repeat copies (default 0.05).")
+    command.add_argument('--read-length', type=int, default=3000, help="Mean read length (default 3000).")
+    command.add_argument('--error-rate', type=float, default=0.08, help="Mean per-base error rate (default 0.08).")
+    command.add_argument('--seed', type=int, default=0, help="Random seed (default 0).")
+
+  compare_command = commands.add_parser('compare', help="Compare two results files.")
+  compare_command.add_argument('old')
+  compare_command.add_argument('new')
+  return parser.parse_args()
+
+def main():
+  args = parse_arguments()
+  set_debug(False)
+  if args.command == 'compare':
+    with open(args.old) as old, open(args.new) as new:
+      compare(json.load(old), json.load(new))
+    return
+
+  if args.command == 'simulate':
+    genome = synthetic_genome(args.size, args.gc, args.repeat_fraction, seed=args.seed)
+    os.makedirs(args.out_dir, exist_ok=True)
+    write_fasta(os.path.join(args.out_dir, 'reference.fasta'), [(CONTIG, to_string(genome))])
+    write_fasta(os.path.join(args.out_dir, 'reads.fasta'), simulate_reads(genome, args.reads, args.read_length, error_rate=args.error_rate, seed=args.seed + 1))
+    return
+
+  configs = [{'size': size, 'k': int(k), 'w': int(w), 'f': args.f, 'threads': threads, 'engine': args.engine, 'align_mode': args.align_mode,
+              'reads': args.reads, 'read_length': args.read_length, 'error_rate': args.error_rate, 'gc': args.gc,
+              'repeat_fraction': args.repeat_fraction, 'seed': args.seed}
+             for size in args.sizes for k, w in (pair.split(':') for pair in args.kw.split(',')) for threads in args.threads]
+  out = args.out or f'./output/benchmark_{datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.json'
+  results = {'created': datetime.datetime.now().isoformat(timespec='seconds'), 'python': sys.version.split()[0], 'runs': []}
+  for run in run_benchmarks(configs):
+    results['runs'].append(run)
+    print(f'size={run["size"]} k={run["k"]} w={run["w"]} threads={run["threads"]}: {run["reads_per_s"]} reads/s, {run["bases_per_s"]} bases/s, '
+          f'peak memory {run["peak_rss_mb"]} MB, precision {run["precision"]}, recall {run["recall"]}')
+    # Written after every point so an interrupted run keeps what it measured
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as file:
+      json.dump(results, file, indent=2)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import numpy as np
+from minimizers import find_minimizer_arrays, encode_kmer, decode_kmer, MAX_K
+from sequence import encode_sequence
+from misc import log
+
+INDEX_FORMAT_VERSION = 2
+INDEX_ARRAYS = ('hashes', 'offsets', 'positions')
+DIGEST_CHUNK = 1 << 24
+STRANDS = ('original', 'reverse_complement')
+
+class MinimizerIndex:
+  # CSR minimizer index: sorted unique 2-bit k-mer values, offsets into the packed
+  # occurrence array ((pos << 1) | strand bit). Same lookup API as a dict of
+  # minimizer -> [(pos, strand)], at 16 bytes per unique minimizer plus 8 per occurrence.
+  # A canonical index stores min(k-mer, reverse complement) and the strand it came from.
+  def __init__(self, hashes, offsets, positions, k, canonical=False):
+    self.hashes = hashes
+    self.offsets = offsets
+    self.positions = positions
+    self.k = k
+    self.canonical = canonical
+
+  @classmethod
+  def from_arrays(cls, values, positions, strands, k, canonical=False):
+    order = np.lexsort((positions, values))
+    values = values[order]
+    packed = (positions[order].astype(np.int64) << 1) | strands[order].astype(np.int64)
+
+    starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1]))) if len(values) else np.empty(0, dtype=np.int64)
+    offsets = np.append(starts, len(values)).astype(np.int64)
+    return cls(values[starts], offsets, packed, k, canonical)
+
+  def find(self, value):
+    idx = np.searchsorted(self.hashes, np.uint64(value))
+    if idx < len(self.hashes) and self.hashes[idx] == value:
+      return idx
+    return -1
+
+  def _find(self, minimizer):
+    value = encode_kmer(str(minimizer)) if len(minimizer) == self.k else None
+    if value is None:
+      return -1
+    return self.find(value)
+
+  def __contains__(self, minimizer):
+    return self._find(minimizer) >= 0
+
+  def __getitem__(self, minimizer):
+    idx = self._find(minimizer)
+    if idx < 0:
+      raise KeyError(minimizer)
+    return self.appearances(idx)
+
+  def __len__(self):
+    return len(self.hashes)
+
+  def counts(self):
+    return np.diff(self.offsets)
+
+  def appearances(self, idx):
+    packed = self.positions[self.offsets[idx]:self.offsets[idx + 1]].tolist()
+    return [(value >> 1, STRANDS[value & 1]) for value in packed]
+
+  def items(self):
+    for idx, value in enumerate(self.hashes.tolist()):
+      yield decode_kmer(value, self.k), self.appearances(idx)
+
+  def remove_top_frequent(self, f):
+    # Same rule as find_top_frequent_minimizers, but with a partial selection instead of a full sort
+    counts = self.counts()
+    threshold_index = int(f * len(counts))
+    if threshold_index <= 0:
+      return self
+    top = np.argpartition(-counts, threshold_index - 1)[:threshold_index]
+    keep = np.ones(len(counts), dtype=bool)
+    keep[top] = False
+
+    keep_positions = np.repeat(keep, counts)
+    offsets = np.concatenate(([0], np.cumsum(counts[keep]))).astype(np.int64)
+    return MinimizerIndex(self.hashes[keep], offsets, self.positions[keep_positions], self.k, self.canonical)
+
+  def nbytes(self):
+    return self.hashes.nbytes + self.offsets.nbytes + self.positions.nbytes
+
+def build_minimizer_index(sequence, k, w, f, strand='original', hash_function='lexicographic', canonical=False, boundaries=None):
+  # Consecutive windows usually share a minimizer, each occurrence is kept once
+  values, positions, strands = find_minimizer_arrays(sequence, k, w, hash_function, canonical, boundaries, distinct=True)
+
+  if not canonical:
+    strands = np.full(len(values), STRANDS.index(strand), dtype=np.int8)
+  index = MinimizerIndex.from_arrays(values, positions, strands, k, canonical)
+  del values, positions, strands
+  return index.remove_top_frequent(f)
+
+def dict_index_memory(minimizer_index):
+  # Deep size of a dict of minimizer -> [(pos, strand)], counting shared objects once
+  seen = set()
+  def size(obj):
+    if id(obj) in seen:
+      return 0
+    seen.add(id(obj))
+    total = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+      total += sum(size(key) + size(value) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+      total += sum(size(item) for item in obj)
+    return total
+  return size(minimizer_index)
+
+def compare_index_memory(sequence, k, w, f, build_dict_index):
+  # Returns (bytes, stored entries) of the dict index and of the array index. The dict index
+  # stores one entry per window, the array index each occurrence once, so their entry counts
+  # differ by the deduplication and the bytes are only comparable per entry.
+  dict_index = build_dict_index(sequence, k, w, f)
+  array_index = build_minimizer_index(sequence, k, w, f)
+  dict_entries = sum(len(appearances) for appearances in dict_index.values())
+  return (dict_index_memory(dict_index), dict_entries), (array_index.nbytes(), len(array_index.positions))
+
+def reference_digest(sequence):
+  # Digest of the base codes, a chunk at a time, the same for a str and a PackedSequence
+  digest = hashlib.sha256()
+  for begin in range(0, len(sequence), DIGEST_CHUNK):
+    digest.update(encode_sequence(sequence[begin:begin + DIGEST_CHUNK]).tobytes())
+  return digest.hexdigest()
+
+def index_cache_path(cache_dir, digest, k, w, f, canonical=False):
+  # digest is the reference_digest of the indexed sequence
+  return os.path.join(cache_dir, f'{digest[:32]}_k{k}_w{w}_f{f}' + ('_canonical' if canonical else ''))
+
+def save_index(index, path, metadata):
+  # Write into a temporary directory first so readers never see a partial index
+  tmp_path = f'{path}.tmp{os.getpid()}'
+  shutil.rmtree(tmp_path, ignore_errors=True)
+  os.makedirs(tmp_path)
+  for name in INDEX_ARRAYS:
+    np.save(os.path.join(tmp_path, f'{name}.npy'), getattr(index, name))
+  with open(os.path.join(tmp_path, 'meta.json'), 'w') as file:
+    json.dump({**metadata, 'version': INDEX_FORMAT_VERSION}, file)
+
+  shutil.rmtree(path, ignore_errors=True)
+  os.replace(tmp_path, path)
+
+def load_index(path, metadata):
+  # Returns None if there is no usable index at path
+  try:
+    with open(os.path.join(path, 'meta.json'), 'r') as file:
+      stored = json.load(file)
+  except (OSError, ValueError):
+    return None
+  if stored != {**metadata, 'version': INDEX_FORMAT_VERSION}:
+    return None
+
+  arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in INDEX_ARRAYS}
+  return MinimizerIndex(k=metadata['k'], canonical=metadata['canonical'], **arrays)
+
+def load_or_build_index(sequence, k, w, f, build, cache_dir=None, rebuild=False, canonical=False, boundaries=None):
+  # build(sequence, k, w, f) creates the in-memory index, it is only called on a cache miss.
+  # canonical and the contig boundaries must match what build produces, they are part of the cache key.
+  if cache_dir is None:
+    return build(sequence, k, w, f)
+  if k > MAX_K:
+    log(f'Minimizer index cache needs k <= {MAX_K}, building in memory', 1)
+    return build(sequence, k, w, f)
+
+  # The digest unpacks and hashes the whole reference, it is computed once per start
+  digest = reference_digest(sequence)
+  metadata = {'reference': digest, 'k': k, 'w': w, 'f': f, 'canonical': canonical}
+  if boundaries is not None and len(boundaries):
+    metadata['contigs'] = hashlib.sha256(np.asarray(boundaries, dtype=np.int64).tobytes()).hexdigest()[:32]
+  path = index_cache_path(cache_dir, digest, k, w, f, canonical)
+  if not rebuild:
+    index = load_index(path, metadata)
+    if index is not None:
+      log(f'Loaded minimizer index from {path}', 1)
+      return index
+
+  index = build(sequence, k, w, f)
+  os.makedirs(cache_dir, exist_ok=True)
+  save_index(index, path, metadata)
+  log(f'Saved minimizer index to {path}', 1)
+
+  # Reload so the returned index is memory-mapped like a cache hit
+  return load_index(path, metadata)
+
+if __name__ == '__main__':
+  # Usage: python index.py <reference.fasta> [k] [w] [f]
+  from reader import read_records
+  from mapping import create_dict_minimizer_index
+  _, reference_seq = next(read_records(sys.argv[1]))
+  k, w, f = (int(sys.argv[2]) if len(sys.argv) > 2 else 15), (int(sys.argv[3]) if len(sys.argv) > 3 else 5), (float(sys.argv[4]) if len(sys.argv) > 4 else 0.001)
+  (dict_bytes, dict_entries), (array_bytes, array_entries) = compare_index_memory(reference_seq, k, w, f, lambda seq, k, w, f: create_dict_minimizer_index(seq, k, w, f, 'original'))
+  print(f'dict index:  {dict_bytes} B, {dict_entries} entries ({dict_bytes / max(1, dict_entries):.1f} B per entry)')
+  print(f'array index: {array_bytes} B, {array_entries} entries ({array_bytes / max(1, array_entries):.1f} B per entry)')
+  print(f'deduplication: {array_entries} of {dict_entries} window minimizers stored ({array_entries / max(1, dict_entries):.1%})')
@@ -1,122 +1,267 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import mapping
-from misc import log, write_output, parse_arguments, load_file, analyze, write_paf,reverse_complement
-from visualization import plot_mapped_genome
+from parallel import map_fragments
+from index import load_or_build_index
+from reader import file_type, read_records, reservoir_sample, SequenceStats
+from reference import ContigTable, pack_contigs
+from sequence import reverse_complement
+from misc import log, set_debug, write_output, parse_arguments
+from output import OutputWriter
+from server import serve
+from visualization import CoverageTrack, plot_coverage, plot_mapped_genome
+from metrics import timer
+import metrics
 import datetime
 import random
+import time
 
 
-def align_fragment(fragment, reference_seq, minimizer_index, fragment_minimizers, k, w, f):
+def align_fragment(fragment, reference_seq, minimizer_index, fragment_minimizers, k, w, f, contigs=None, band=None, align_mode='region', max_band_cells=mapping.MAX_BAND_CELLS, min_chain_score=40, max_chains=5, x_drop=40,
+                   max_occurrences=200, min_anchors=3, min_anchor_density=1.0, min_chain_coverage=0.05):
+  if align_mode == 'region' and len(fragment) > mapping.MAX_REGION_LENGTH:
+    log(f'Fragment longer than {mapping.MAX_REGION_LENGTH} bp, skipping fragment (use --align-mode chain)', 1)
+    metrics.count('rejected_length')
+    return None
+
   log('Finding matches...', 1)
-  matches = mapping.find_matches(fragment, k, w, f, minimizer_index, "original",fragment_minimizers)
-  rev_matches = mapping.find_matches(reverse_complement(fragment), k, w, f, minimizer_index, "reverse_complement",None)
-
-  log('Finding longest increasing subsequence...', 1)
-  lis = mapping.longest_increasing_subsequence(matches)
-  log('Finding longest increasing subsequence (complement)...', 1)
-  rev_lis = mapping.longest_increasing_subsequence(rev_matches)
-  lis = lis if len(lis) > len(rev_lis) else rev_lis
-  
-  q_begin, q_end = lis[0][0], lis[-1][0]
-  t_begin, t_end = lis[0][1], lis[-1][1]
+  with timer('seeding'):
+    if getattr(minimizer_index, 'canonical', False):
+      # Canonical minimizers give both orientations from a single lookup
+      matches, rev_matches = mapping.find_stranded_matches(fragment_minimizers, minimizer_index, len(fragment), k, max_occurrences)
+    else:
+      matches = mapping.find_matches(fragment, k, w, f, minimizer_index, "original",fragment_minimizers, max_occurrences)
+      rev_matches = mapping.find_matches(reverse_complement(fragment), k, w, f, minimizer_index, "reverse_complement",None, max_occurrences)
+  metrics.count('anchors', len(matches) + len(rev_matches))
 
-  q_begin = max(0, q_begin - 50)
-  q_end = min(len(fragment), q_end + 50)
-  t_begin = max(0, t_begin - 50)
-  t_end = min(len(reference_seq), t_end + 50)
-  
-  if t_begin > t_end:
-    t_begin, t_end = t_end, t_begin
-  
-  log('Aligning region...', 1)
-  log(f'fragment_begin: {q_begin}, fragment_end: {q_end}, reference_begin: {t_begin}, reference_end: {t_end}', 2)
-  log(f'fragment length: {len(fragment)}, sequence part length: {len(reference_seq[t_begin:t_end])}', 2)
-  aligned_seq1, aligned_seq2, alignment_score, cigar = mapping.align_region(fragment[q_begin:q_end], reference_seq[t_begin:t_end])
-  
-  return fragment, 'reference_genome', q_begin, q_end, t_begin, t_end, aligned_seq1, aligned_seq2, alignment_score, cigar
+  # Prefilter: reads that can't map are rejected here, before any chaining or DP
+  if not mapping.anchor_filter(matches, rev_matches, len(fragment), min_anchors, min_anchor_density):
+    log('Too few anchors, skipping fragment', 1)
+    metrics.count('rejected_anchors')
+    return None
+
+  # reference_seq is the packed reference, contigs maps its positions back to contigs
+  if contigs is None:
+    contigs = ContigTable(['reference_genome'], [len(reference_seq)])
+
+  log('Chaining anchors...', 1)
+  with timer('chaining'):
+    # Anchors are chained per contig so no chain runs across a boundary
+    chains = []
+    for chain_strand, strand_matches in (('original', matches), ('reverse_complement', rev_matches)):
+      for contig_matches in contigs.group(strand_matches):
+        chains += [(score, chain_strand, anchors) for score, anchors in mapping.chain_anchors(contig_matches, k, min_chain_score=min_chain_score, min_anchors=min_anchors, max_chains=max_chains)]
+  chains = sorted(chains, key=lambda x: x[0], reverse=True)[:max_chains]
+  metrics.count('chains', len(chains))
+  if not chains:
+    log('No chain above the minimum chain score, skipping fragment', 1)
+    metrics.count('rejected_chain_score')
+    return None
+  if mapping.chain_coverage(chains[0][2], k, len(fragment)) < min_chain_coverage:
+    log('Best chain covers too little of the fragment, skipping fragment', 1)
+    metrics.count('rejected_chain_coverage')
+    return None
+
+  _, strand, lis = chains[0]
+  query = fragment if strand == 'original' else reverse_complement(fragment)
+  secondary_hits = []
+  for score, hit_strand, anchors in chains[1:]:
+    hit_q_begin, hit_q_end = anchors[0][0], anchors[-1][0] + k
+    if hit_strand == 'reverse_complement':
+      hit_q_begin, hit_q_end = len(fragment) - hit_q_end, len(fragment) - hit_q_begin
+    hit_contig, hit_t_begin = contigs.locate(anchors[0][1])
+    secondary_hits.append((hit_strand, hit_q_begin, hit_q_end, contigs.names[hit_contig], hit_t_begin, hit_t_begin + anchors[-1][1] + k - anchors[0][1], score))
+
+  # The primary chain is aligned in the local coordinates of its contig
+  contig_id, _ = contigs.locate(lis[0][1])
+  contig_start = int(contigs.starts[contig_id])
+  lis = [(pos, ref_pos - contig_start) + tuple(rest) for pos, ref_pos, *rest in lis]
+  reference_seq = contigs.view(reference_seq, contig_id)
+
+  # With X-drop extension only the anchored part is aligned here, otherwise it is padded by 50 bp
+  padding = 0 if x_drop > 0 else 50
+  alignment = None
+  if align_mode == 'chain':
+    log('Aligning chain...', 1)
+    with timer('alignment'):
+      alignment = mapping.align_chain(query, reference_seq, lis, k, padding=padding, band=band, max_band_cells=max_band_cells)
+
+  if alignment is None:
+    q_begin, q_end = lis[0][0], lis[-1][0] + k
+    t_begin, t_end = lis[0][1], lis[-1][1] + k
+
+    q_begin = max(0, q_begin - padding)
+    q_end = min(len(fragment), q_end + padding)
+    t_begin = max(0, t_begin - padding)
+    t_end = min(len(reference_seq), t_end + padding)
 
-def process_fragment(index,fragment,num_of_fragments,k,w,f,reference_seq,minimizer_index,output_filename):
+    if t_begin > t_end:
+      t_begin, t_end = t_end, t_begin
+
+    log('Aligning region...', 1)
+    log(f'fragment_begin: {q_begin}, fragment_end: {q_end}, reference_begin: {t_begin}, reference_end: {t_end}', 2)
+    log(f'fragment length: {len(fragment)}, sequence part length: {len(reference_seq[t_begin:t_end])}', 2)
+    with timer('alignment'):
+      alignment = (q_begin, q_end, t_begin, t_end) + mapping.align_region(query[q_begin:q_end], reference_seq[t_begin:t_end], band, max_band_cells)
+
+  if x_drop > 0:
+    log('Extending alignment ends...', 1)
+    with timer('extension'):
+      alignment = mapping.extend_alignment(query, reference_seq, *alignment, x_drop=x_drop)
+
+  q_begin, q_end, t_begin, t_end, alignment, alignment_score = alignment
+  if strand == 'reverse_complement':
+    # Query coordinates are reported on the original fragment, the alignment is of its reverse complement
+    q_begin, q_end = len(fragment) - q_end, len(fragment) - q_begin
+
+  return fragment, contigs.names[contig_id], q_begin, q_end, t_begin, t_end, alignment, alignment_score, secondary_hits, strand
+
+def fragment_cost(fragment, w):
+  # Estimated mapping cost for the scheduler: length x expected anchors (about 2 / (w + 1) minimizers per base)
+  return len(fragment) * len(fragment) * 2 / (w + 1)
+
+def process_fragment(index,fragment,num_of_fragments,k,w,f,reference_seq,minimizer_index,output_filename,**options):
     log(f'Fragment {index+1} of {num_of_fragments}...')
     log('Finding minimizers for fragment...', 1)
-    fragment_minimizers = mapping.create_minimizer_index(fragment, k, w, f,"original")
-      
-    result = align_fragment(fragment, reference_seq, minimizer_index, fragment_minimizers, k, w, f)
+    with timer('minimizers'):
+      fragment_minimizers = mapping.create_minimizer_index(fragment, k, w, f,"original", canonical=getattr(minimizer_index, 'canonical', False))
+    metrics.count('reads')
+    metrics.count('minimizers', len(fragment_minimizers))
+
+    result = align_fragment(fragment, reference_seq, minimizer_index, fragment_minimizers, k, w, f, **options)
+    metrics.count('mapped' if result is not None else 'unmapped')
     log(f'Done!', 1)
     return result     
 
 def main():
-  current_time = datetime.datetime.now()
-  output_filename = f'./output/output_{current_time.strftime("%Y-%m-%d_%H-%M-%S")}.txt'
   args = parse_arguments()
-  
+  set_debug(args.debug)
+  current_time = datetime.datetime.now()
+  output_prefix = f'./output/output_{current_time.strftime("%Y-%m-%d_%H-%M-%S")}'
+
+  # Stage timers and counters are written as JSON and TSV next to the output on every run
+  started = time.perf_counter()
+  profiler = metrics.Profiler(f'{output_prefix}.prof' if args.profile else None, args.trace_memory)
+  with profiler:
+    map_reads(args, f'{output_prefix}.txt', f'{output_prefix}.paf', output_prefix)
+  extra = {'memory': profiler.memory} if profiler.memory else None
+  metrics.write_summary(metrics.summary(time.perf_counter() - started, extra), f'{output_prefix}.metrics.json', f'{output_prefix}.metrics.tsv')
+
+def map_reads(args, output_filename, paf_filename, output_prefix):
   k = args.k if args.k else 15
   w = args.w if args.w else 5
   f = args.f if args.f else 0.001
   debug = args.debug
   threads = args.threads if args.threads else 1
+  engine = args.engine
+  band = args.band
+  align_mode = args.align_mode
+  max_band_cells = args.max_band_cells if args.max_band_cells else mapping.MAX_BAND_CELLS
+  min_chain_score = args.min_chain_score if args.min_chain_score is not None else 40
+  max_chains = args.max_chains if args.max_chains else 5
+  x_drop = args.x_drop if args.x_drop is not None else 40
+  max_occurrences = args.max_occurrences if args.max_occurrences is not None else 200
+  min_anchors = args.min_anchors if args.min_anchors is not None else 3
+  min_anchor_density = args.min_anchor_density if args.min_anchor_density is not None else 1.0
+  min_chain_coverage = args.min_chain_coverage if args.min_chain_coverage is not None else 0.05
+  options = {'band': band, 'align_mode': align_mode, 'max_band_cells': max_band_cells, 'min_chain_score': min_chain_score, 'max_chains': max_chains, 'x_drop': x_drop,
+             'max_occurrences': max_occurrences, 'min_anchors': min_anchors, 'min_anchor_density': min_anchor_density, 'min_chain_coverage': min_chain_coverage}
+  # Region mode skips reads over 5000 bp, the sample is drawn from the reads it can map
+  max_fragment_length = None if align_mode == 'chain' else mapping.MAX_REGION_LENGTH
+  sample_size = args.sample
   cigar = args.cigar
   reference_filepath = args.reference
   fragments_filepath = args.fragments
+  index_dir = args.index_dir
+  if (args.rebuild_index or args.build_index) and not index_dir:
+    index_dir = './index'
 
-  log(f'--Using: k={k}, w={w}, f={f} debug={debug} threads={threads} cigar={cigar}', 0)
-  
-  # Load reference genome and fragments files
-  reference, reference_filetype = load_file(reference_filepath)
-  fragments, fragments_filetype = load_file(fragments_filepath)
-  # Adjust filetypes
-  if reference_filetype in ['fasta', 'fas', 'fa', 'fna', 'ffn', 'faa', 'mpfa', 'frn']:
-    reference_filetype = 'fasta'
-  if fragments_filetype in ['fasta', 'fas', 'fa', 'fna', 'ffn', 'faa', 'mpfa', 'frn']:
-    fragments_filetype = 'fasta'
-  if fragments_filetype in ['fastq', 'fq']:
-    fragments_filetype = 'fastq'
+  log(f'--Using: k={k}, w={w}, f={f} debug={debug} threads={threads} engine={engine} align_mode={align_mode} cigar={cigar}', 0)
   
-  log("Input files loaded, filetypes (reference, fragments):")
+  # Reference and fragments files are streamed, statistics are gathered on the same pass
+  reference_filetype = file_type(reference_filepath)
+  fragments_filetype = file_type(fragments_filepath) if fragments_filepath else None
+  log("Input files found, filetypes (reference, fragments):")
   log(f'Reference: {reference_filetype}, Fragments: {fragments_filetype}', 1)
-  
-  stats_reference = analyze(reference_filepath, reference_filetype)
-  write_output(f'STATS:\n(contig_count, min, max, avg, n_50)\n{str(stats_reference[:-1])}', output_filename)
-  stats_fragment = analyze(fragments_filepath, fragments_filetype)
-  write_output(f'(contig_count, min, max, avg, n_50)\n{str(stats_fragment[:-1])}\n-------------------\n', output_filename)
+
+  # All contigs are packed into one sequence and indexed in one pass
+  stats_reference = SequenceStats()
+  with timer('parse_reference'):
+    reference_seq, contigs = pack_contigs(read_records(reference_filepath, stats_reference, packed=True))
+  log(f'Reference contigs: {len(contigs)}, total length: {contigs.total_length()}', 1)
+  write_output(f'STATS:\n(contig_count, min, max, avg, n_50)\n{str(stats_reference.summary())}', output_filename)
+
+  log('Creating minimizer index for reference...')
+  with timer('index'):
+    minimizer_index = load_or_build_index(reference_seq, k, w, f, lambda seq, k, w, f: mapping.create_minimizer_index(seq, k, w, f, strand="original", canonical=True, boundaries=contigs.boundaries()), index_dir, args.rebuild_index, canonical=True, boundaries=contigs.boundaries())
+  log('--------------------------------------')
+  if args.build_index:
+    return
+
+  if args.serve:
+    process_kwargs = {'num_of_fragments': None, 'k': k, 'w': w, 'f': f, 'output_filename': output_filename, 'contigs': contigs, **options}
+    serve(process_fragment, process_kwargs, reference_seq, minimizer_index, contigs, threads, engine, args.socket, args.port, cigar)
+    return
 
   #############################################################################
-  
-  reference_seq = stats_reference[-1][0].seq
-  all_fragments_seqs = [record.seq for record in stats_fragment[-1]]
-  log(f'Number of fragments: {len(all_fragments_seqs)}', 1)
-  
-  fragments_seqs = []
-  while len(fragments_seqs) < 100:
-    random_int = random.randint(0, len(stats_fragment[-1]))
-    if len(all_fragments_seqs[random_int]) <= 5000:
-      fragments_seqs.append(all_fragments_seqs[random_int])
-  
+
+  stats_fragment = SequenceStats()
+  if sample_size:
+    # Sample mode: a seeded uniform sample in one pass, only the sample is kept in memory
+    with timer('parse_fragments'):
+      fragments = reservoir_sample(read_records(fragments_filepath, stats_fragment), sample_size, max_fragment_length, random.Random(args.seed))
+    write_output(f'(contig_count, min, max, avg, n_50)\n{str(stats_fragment.summary())}\n-------------------\n', output_filename)
+    log(f'Number of fragments: {len(stats_fragment.lengths)}', 1)
+    num_of_fragments = len(fragments)
+  else:
+    # Every fragment is mapped, streamed from the file as the scheduler needs them.
+    # Statistics are only known at the end, they follow the results in the report.
+    fragments = metrics.timed_iter('parse_fragments', read_records(fragments_filepath, stats_fragment))
+    num_of_fragments = None
+
   #############################################################################
+  # Coverage bins and a fixed-size pileup sample are updated as results arrive, single
+  # alignments are only kept for the one-line-per-read window
+  track = CoverageTrack(len(reference_seq)) if args.plot == 'coverage' else None
   results = []
-  
-  log('Creating minimizer index for reference...')
-  minimizer_index = mapping.create_minimizer_index(reference_seq, k, w, f,strand="original")
-  log('--------------------------------------')
-  
-  
-  with ThreadPoolExecutor(max_workers=threads) as executor:
-    future_to_fragment = {executor.submit(process_fragment, index,fragment,len(fragments_seqs),k,w,f,reference_seq,minimizer_index,output_filename): fragment for index,fragment in enumerate(fragments_seqs)}
-    for future in as_completed(future_to_fragment):
-      try:
-        result = future.result()
-        results.append(result)
-      except Exception as exc:
-        log(f'Fragment generated an exception: {exc}')
-
-  for result in results:
-    fragment, ref_name, q_begin, q_end, t_begin, t_end, aligned_seq1, aligned_seq2, alignment_score, cigar_str = result
-
-    mapping.print_paf(fragment, ref_name, q_begin, q_end, t_begin, t_end, aligned_seq1, aligned_seq2, alignment_score, output_filename)
-    write_output(f'{fragment}\t{len(fragment)}\t{q_begin}\t{q_end}\t+\t{ref_name}\t{len(ref_name)}\t{t_begin}\t{t_end}\t{alignment_score}\t60', output_filename)
-    write_paf(aligned_seq1, aligned_seq2, './output/output.paf', query_name='fragment', target_name='reference_genome',cigar=True)
-  
-   
-  plot_mapped_genome(results, len(reference_seq))
+  unmapped = 0
+
+  process_kwargs = {'num_of_fragments': num_of_fragments, 'k': k, 'w': w, 'f': f, 'output_filename': output_filename, 'contigs': contigs, **options}
+  items = ((index, name, fragment) for index, (name, fragment) in enumerate(fragments))
+  # Report and PAF lines are formatted and written by the writer thread as results complete
+  # (in input order with --ordered)
+  with OutputWriter(output_filename, paf_filename, contigs, cigar=cigar) as writer:
+    for index, name, result, error in map_fragments(items, process_fragment, process_kwargs, reference_seq, minimizer_index, threads, engine,
+                                                    cost=lambda fragment: fragment_cost(fragment, w), ordered=args.ordered):
+      if error is not None:
+        log(f'Fragment generated an exception: {error}')
+        continue
+      if result is None:
+        writer.write_unmapped(name)
+        unmapped += 1
+        continue
+
+      writer.write_result(name, result)
+      if args.plot == 'none':
+        continue
+      _, ref_name, q_begin, q_end, t_begin, t_end, _, alignment_score = result[:8]
+      # The plot shows the packed reference, contigs one after another
+      contig_start = contigs.start(ref_name)
+      if track is not None:
+        track.add(contig_start + t_begin, contig_start + t_end)
+      else:
+        results.append((None, ref_name, q_begin, q_end, contig_start + t_begin, contig_start + t_end, None, alignment_score))
+
+  if not sample_size:
+    write_output(f'-------------------\n(contig_count, min, max, avg, n_50)\n{str(stats_fragment.summary())}', output_filename)
+    log(f'Number of fragments: {len(stats_fragment.lengths)}', 1)
+  write_output(f'Unmapped fragments: {unmapped}', output_filename)
+  log(f'Unmapped fragments: {unmapped}', 1)
+
+  if args.plot == 'coverage':
+    with timer('plot'):
+      paths = plot_coverage(track, output_prefix, contigs)
+    log(f'Coverage plot: {", ".join(paths)}', 1)
+  elif args.plot == 'reads':
+    plot_mapped_genome(results, len(reference_seq))
 
 
 if __name__ == '__main__':
@@ -1,8 +1,12 @@
-from minimizers import find_minimizers
-from collections import defaultdict, deque
-from alignment import needleman_wunsch, smith_waterman, semi_global
+import numpy as np
+from minimizers import find_minimizers, MAX_K
+from index import MinimizerIndex, build_minimizer_index, STRANDS
+from collections import defaultdict
+from alignment import Alignment, xdrop_extend, banded_needleman_wunsch, checkpointed_banded_needleman_wunsch, band_width
 from bisect import bisect_left
-from misc import log,reverse_complement
+import metrics
+from sequence import encode_sequence
+from reference import spanning_kmers
 
 def find_top_frequent_minimizers(minimizer_counts, f):
   sorted_minimizers = sorted(minimizer_counts.items(), key=lambda x: x[1], reverse=True)
@@ -12,12 +16,20 @@ def find_top_frequent_minimizers(minimizer_counts, f):
   
   return minimizers_to_remove
 
-def create_minimizer_index(sequence, k, w, f,strand):
+def create_minimizer_index(sequence, k, w, f,strand, canonical=False, boundaries=None):
+  if k > MAX_K:
+    return create_dict_minimizer_index(sequence, k, w, f, strand, boundaries)
+  return build_minimizer_index(sequence, k, w, f, strand, canonical=canonical, boundaries=boundaries)
+
+def create_dict_minimizer_index(sequence, k, w, f,strand, boundaries=None):
   minimizer_counts = defaultdict(int)
   minimizer_positions = defaultdict(list)
+  spanning = spanning_kmers(len(sequence), k, boundaries) if boundaries is not None else None
   
   minimizers = find_minimizers(sequence, k, w,strand)
   for minimizer, pos, strand, k, w in minimizers:
+    if spanning is not None and spanning[pos]:
+      continue
     minimizer_counts[minimizer] += 1
     minimizer_positions[minimizer].append((pos, strand))
   
@@ -29,13 +41,21 @@ def create_minimizer_index(sequence, k, w, f,strand):
   
   return minimizer_positions
 
-def find_matches(fragment, k, w, f, minimizer_index, strand, fragment_minimizers=None):
+def find_matches(fragment, k, w, f, minimizer_index, strand, fragment_minimizers=None, max_occurrences=None):
+  # max_occurrences skips minimizers seen more often than that in the reference
   if fragment_minimizers is None:
     fragment_minimizers = create_minimizer_index(fragment, k, w, f,strand)
 
+  if isinstance(fragment_minimizers, MinimizerIndex) and isinstance(minimizer_index, MinimizerIndex):
+    matches = find_index_matches(fragment_minimizers, minimizer_index, max_occurrences)
+    return sorted(matches, key=lambda x: (x[0], x[1]))
+
   matches = []
   
   for minimizer, appearances in fragment_minimizers.items():
+    if max_occurrences and minimizer in minimizer_index and len(minimizer_index[minimizer]) > max_occurrences:
+      metrics.count('capped_minimizers')
+      continue
     for appearance in appearances:
       pos, strand = appearance
       if minimizer in minimizer_index:
@@ -47,67 +67,238 @@ def find_matches(fragment, k, w, f, minimizer_index, strand, fragment_minimizers
   
   return matches
   
-def longest_increasing_subsequence(matches):
-  positions = [match[0] for match in matches]
-  ref_positions = [match[1] for match in matches]
-  minimizers = [match[2] for match in matches]
+def find_index_matches(fragment_minimizers, minimizer_index, max_occurrences=None):
+  # Look up all fragment minimizers in the reference index with one searchsorted call
+  matches = []
+  if len(fragment_minimizers) == 0 or len(minimizer_index) == 0:
+    return matches
+
+  ref_indices = np.searchsorted(minimizer_index.hashes, fragment_minimizers.hashes)
+  ref_indices = np.minimum(ref_indices, len(minimizer_index) - 1)
+  found = capped_hits(minimizer_index, ref_indices, minimizer_index.hashes[ref_indices] == fragment_minimizers.hashes, max_occurrences)
+
+  for idx, ref_idx in zip(found.tolist(), ref_indices[found].tolist()):
+    minimizer = int(fragment_minimizers.hashes[idx])
+    ref_appearances = minimizer_index.appearances(ref_idx)
+    for pos, strand in fragment_minimizers.appearances(idx):
+      for ref_pos, ref_strand in ref_appearances:
+        matches.append((pos, ref_pos, minimizer, strand, ref_strand))
+
+  return matches
+  
+def capped_hits(minimizer_index, ref_indices, hits, max_occurrences=None):
+  # Indices of the hits whose minimizer occurs at most max_occurrences times in the reference.
+  # Repeats that f did not remove would otherwise add that many anchors per query minimizer.
+  if max_occurrences:
+    frequent = hits & (minimizer_index.offsets[ref_indices + 1] - minimizer_index.offsets[ref_indices] > max_occurrences)
+    metrics.count('capped_minimizers', int(frequent.sum()))
+    hits = hits & ~frequent
+  return np.flatnonzero(hits)
 
-  n = len(positions)
-  lis = []
-  predecessors = [-1] * n
-  lis_indices = []
+def find_stranded_matches(fragment_minimizers, minimizer_index, fragment_length, k, max_occurrences=None):
+  # Both orientations from one lookup of two canonical indexes. Hits whose strands agree are
+  # forward matches, the others are matches of the reverse complemented fragment and their
+  # positions are translated into its coordinates.
+  matches, rev_matches = [], []
+  if len(fragment_minimizers) == 0 or len(minimizer_index) == 0:
+    return matches, rev_matches
 
-  last_index = -1
+  ref_indices = np.searchsorted(minimizer_index.hashes, fragment_minimizers.hashes)
+  ref_indices = np.minimum(ref_indices, len(minimizer_index) - 1)
+  found = capped_hits(minimizer_index, ref_indices, minimizer_index.hashes[ref_indices] == fragment_minimizers.hashes, max_occurrences)
 
-  for i, pos in enumerate(positions):
+  offsets, positions = fragment_minimizers.offsets, fragment_minimizers.positions
+  ref_offsets, ref_positions = minimizer_index.offsets, minimizer_index.positions
+  for idx, ref_idx in zip(found.tolist(), ref_indices[found].tolist()):
+    minimizer = int(fragment_minimizers.hashes[idx])
+    ref_packed = ref_positions[ref_offsets[ref_idx]:ref_offsets[ref_idx + 1]].tolist()
+    for packed in positions[offsets[idx]:offsets[idx + 1]].tolist():
+      pos, strand = packed >> 1, packed & 1
+      for ref_value in ref_packed:
+        ref_pos, ref_strand = ref_value >> 1, ref_value & 1
+        if strand == ref_strand:
+          matches.append((pos, ref_pos, minimizer, 'original', STRANDS[ref_strand]))
+        else:
+          rev_matches.append((fragment_length - pos - k, ref_pos, minimizer, 'reverse_complement', STRANDS[ref_strand]))
 
-    if minimizers[i] == minimizers[i - 1]:
+  return sorted(matches, key=lambda x: (x[0], x[1])), sorted(rev_matches, key=lambda x: (x[0], x[1]))
+
+def chain_anchors(matches, k, max_gap=5000, bandwidth=500, max_predecessors=50, min_chain_score=40, min_anchors=3, max_chains=5):
+  # Minimap2-style chaining. Anchors are sorted by reference position and each one looks back
+  # at most max_predecessors anchors: f(i) = max(k, f(j) + min(dq, dr, k) - gap_cost(|dq - dr|)).
+  # Returns up to max_chains (score, anchors) with disjoint anchors and non-overlapping
+  # reference spans, best first. Anchors of a chain are ordered by reference position.
+  if not matches:
+    return []
+  anchors = sorted(matches, key=lambda x: (x[1], x[0]))
+  positions = np.array([anchor[0] for anchor in anchors], dtype=np.int64)
+  ref_positions = np.array([anchor[1] for anchor in anchors], dtype=np.int64)
+
+  n = len(anchors)
+  scores = np.full(n, k, dtype=np.float64)
+  predecessors = np.full(n, -1, dtype=np.int64)
+  for i in range(1, n):
+    begin = max(0, i - max_predecessors)
+    dq = positions[i] - positions[begin:i]
+    dr = ref_positions[i] - ref_positions[begin:i]
+    gap = np.abs(dq - dr)
+    valid = (dq > 0) & (dr > 0) & (dq <= max_gap) & (dr <= max_gap) & (gap <= bandwidth)
+    if not valid.any():
       continue
+    gap_cost = np.where(gap > 0, 0.01 * k * gap + 0.5 * np.log2(np.maximum(gap, 1)), 0)
+    candidates = np.where(valid, scores[begin:i] + np.minimum(np.minimum(dq, dr), k) - gap_cost, -np.inf)
+    best = int(np.argmax(candidates))
+    if candidates[best] > k:
+      scores[i] = candidates[best]
+      predecessors[i] = begin + best
 
-    if lis_indices and abs(ref_positions[i] - ref_positions[lis_indices[last_index]]) > 500:
-        break
-    
-    idx = bisect_left([positions[j] for j in lis_indices], pos)
+  chains = []
+  used = np.zeros(n, dtype=bool)
+  spans = []
+  for i in np.argsort(-scores, kind='stable').tolist():
+    if used[i]:
+      continue
+    members = []
+    j = i
+    while j != -1 and not used[j]:
+      members.append(j)
+      j = predecessors[j]
+    used[members] = True
+    # A chain that runs into an earlier chain only keeps the score it added on top of it
+    score = scores[i] - (scores[j] if j != -1 else 0)
+    if score < min_chain_score or len(members) < min_anchors:
+      continue
 
-    if idx < len(lis_indices):
-      lis_indices[idx] = i
-      last_index = idx
-    else:
-      last_index = len(lis_indices)
-      lis_indices.append(i)
-    
-    if idx > 0:
-      predecessors[i] = lis_indices[idx - 1]
+    members.reverse()
+    t_begin, t_end = ref_positions[members[0]], ref_positions[members[-1]] + k
+    if any(t_begin < end and begin < t_end for begin, end in spans):
+      continue
+    spans.append((t_begin, t_end))
+    chains.append((float(score), [anchors[member] for member in members]))
+    if len(chains) == max_chains:
+      break
+
+  return chains
+
+def anchor_filter(matches, rev_matches, fragment_length, min_anchors=3, min_anchor_density=1.0):
+  # Prefilter before chaining: reads whose better strand has fewer than min_anchors anchors,
+  # or fewer than min_anchor_density anchors per kb of read, are not worth chaining
+  anchors = max(len(matches), len(rev_matches))
+  return anchors >= min_anchors and anchors * 1000 >= min_anchor_density * fragment_length
+
+def chain_coverage(anchors, k, fragment_length):
+  # Fraction of the read spanned by a chain's anchors
+  positions = [anchor[0] for anchor in anchors]
+  return (max(positions) + k - min(positions)) / max(fragment_length, 1)
+
+# Above this many traceback cells only checkpoint rows of the band are kept
+MAX_BAND_CELLS = 50_000_000
+# Longest read region mode aligns, longer ones are left to chain mode
+MAX_REGION_LENGTH = 5000
+
+def align_region(fragment, ref_seq, band=None, max_band_cells=MAX_BAND_CELLS):
+  # Use banded Needleman-Wunsch around the chain diagonal, band=None picks an adaptive width
+  band_cells = (len(fragment) + 1) * (2 * band_width(len(fragment), len(ref_seq), band) + 1)
+  if band_cells > max_band_cells:
+    _, alignment, alignment_score = checkpointed_banded_needleman_wunsch(fragment, ref_seq, band=band)
+  else:
+    _, alignment, alignment_score = banded_needleman_wunsch(fragment, ref_seq, band=band)
+  return alignment, alignment_score
+
+def colinear_anchors(chain):
+  # Longest subset of the chain increasing in both query and reference position
+  tails, tail_indices = [], []
+  predecessors = [-1] * len(chain)
+  for i, (pos, ref_pos, *_) in enumerate(chain):
+    idx = bisect_left(tails, ref_pos)
+    if idx > 0 and chain[tail_indices[idx - 1]][0] >= pos:
+      continue
+    if idx < len(tails):
+      tails[idx], tail_indices[idx] = ref_pos, i
     else:
-      predecessors[i] = -1
-      
-    if i % 100000 == 0:
-      log(f"{i} / {n}", 2)
-  
-  if not lis_indices:
-    return []
-  
-  k = lis_indices[-1]
-  lis = []
-  while k != -1:
-    lis.append(matches[k])
-    k = predecessors[k]
-  
-  lis.reverse()
-  return lis
-
-def align_region(fragment, ref_seq):
-  # Use Needleman-Wunsch alignment algorithm on the specified region
-  _, aligned_seq1, aligned_seq2, alignment_score, cigar = needleman_wunsch(fragment, ref_seq)
-  return aligned_seq1, aligned_seq2, alignment_score, cigar
-
-def print_paf(fragment_lis, reference_lis, q_begin, q_end, t_begin, t_end, aligned_seq1, aligned_seq2, alignment_score,output_filename):
-#   print(f"{fragment}\t{len(fragment)}\t{q_begin}\t{q_end}\t+\t{ref_name}\t{len(ref_name)}\t{t_begin}\t{t_end}\t{alignment_score}\t60")
-  with open(output_filename, 'a') as file:
-    #{fragment}
-    file.write(f"{aligned_seq1}\n")
-    file.write(f"{aligned_seq2}\n")
-    file.write('<><><><><><><><><><><><><><><><><><>\n')
-    file.write(f"{fragment_lis}\n")
-    file.write(f"{reference_lis}\n")
-    file.write(f"\tAlignment Score: {alignment_score}\n")
+      tails.append(ref_pos)
+      tail_indices.append(i)
+    predecessors[i] = tail_indices[idx - 1] if idx > 0 else -1
+
+  anchors = []
+  i = tail_indices[-1] if tail_indices else -1
+  while i != -1:
+    anchors.append(chain[i])
+    i = predecessors[i]
+  anchors.reverse()
+  return anchors
+
+def anchor_blocks(fragment, ref_seq, anchors, k):
+  # Merge anchors into non-overlapping exact-match blocks (q_begin, t_begin, length)
+  fragment, ref_seq = encode_sequence(fragment), encode_sequence(ref_seq)
+  blocks = []
+  for pos, ref_pos, *_ in anchors:
+    if fragment[pos:pos+k].tobytes() != ref_seq[ref_pos:ref_pos+k].tobytes():
+      continue
+    if blocks:
+      q, t, length = blocks[-1]
+      if pos - ref_pos == q - t and pos <= q + length:
+        # Overlapping anchor on the same diagonal extends the block
+        blocks[-1] = (q, t, max(length, pos + k - q))
+        continue
+      if pos < q + length or ref_pos < t + length:
+        continue
+    blocks.append((pos, ref_pos, k))
+  return blocks
+
+def align_chain(fragment, ref_seq, chain, k, padding=50, band=None, match=1, max_band_cells=MAX_BAND_CELLS):
+  # Align only the gaps between exact anchor blocks (and the padded ends), then stitch
+  # the pieces' ops into one alignment. Returns the same fields as the region alignment.
+  # The reference is unpacked once, for the window the chain and its padding cover.
+  fragment = encode_sequence(fragment)
+  anchors = colinear_anchors(chain)
+  if not anchors:
+    return None
+  window_begin = max(0, anchors[0][1] - padding)
+  window = encode_sequence(ref_seq[window_begin:anchors[-1][1] + k + padding])
+  blocks = [(q, t + window_begin, length) for q, t, length in anchor_blocks(fragment, window, [(pos, ref_pos - window_begin) for pos, ref_pos, *_ in anchors], k)]
+  if not blocks:
+    return None
+
+  q_begin = max(0, blocks[0][0] - padding)
+  t_begin = max(0, blocks[0][1] - padding)
+  q_end = min(len(fragment), blocks[-1][0] + blocks[-1][2] + padding)
+  t_end = min(window_begin + len(window), blocks[-1][1] + blocks[-1][2] + padding)
+
+  ops, lengths = [], []
+  alignment_score = 0
+  q, t = q_begin, t_begin
+  for block_q, block_t, length in blocks + [(q_end, t_end, 0)]:
+    if block_q > q or block_t > t:
+      gap_alignment, gap_score = align_region(fragment[q:block_q], window[t - window_begin:block_t - window_begin], band, max_band_cells)
+      ops.append(gap_alignment.ops)
+      lengths.append(gap_alignment.lengths)
+      alignment_score += gap_score
+    if length:
+      ops.append([0])
+      lengths.append([length])
+    alignment_score += length * match
+    q, t = block_q + length, block_t + length
+
+  alignment = Alignment(fragment[q_begin:q_end], window[t_begin - window_begin:t_end - window_begin], np.concatenate(ops), np.concatenate(lengths), q_begin, t_begin)
+  return q_begin, q_end, t_begin, t_end, alignment, alignment_score
+
+def extend_alignment(fragment, ref_seq, q_begin, q_end, t_begin, t_end, alignment, alignment_score, x_drop=40):
+  # Extend an anchored alignment outward from both ends with X-drop, the fragment bases
+  # beyond where the extensions stop become soft clips. Returns the same fields.
+  fragment = encode_sequence(fragment)
+  right_length = len(fragment) - q_end
+  right_score, right = xdrop_extend(fragment[q_end:], ref_seq[t_end:t_end + 2 * right_length + x_drop], x_drop=x_drop)
+
+  # The left end is extended on the reversed sequences, its runs are reversed back
+  left_window = max(0, t_begin - 2 * q_begin - x_drop)
+  left_score, left = xdrop_extend(fragment[:q_begin][::-1], encode_sequence(ref_seq[left_window:t_begin])[::-1], x_drop=x_drop)
+
+  q_begin, t_begin = q_begin - len(left.seq1), t_begin - len(left.seq2)
+  q_end, t_end = q_end + len(right.seq1), t_end + len(right.seq2)
+  ops = np.concatenate((left.ops[::-1], alignment.ops, right.ops))
+  lengths = np.concatenate((left.lengths[::-1], alignment.lengths, right.lengths))
+  # The middle is taken from the existing alignment, only the extensions come from ref_seq
+  seq2 = np.concatenate((left.seq2[::-1], alignment.seq2, right.seq2))
+  alignment = Alignment(fragment[q_begin:q_end], seq2, ops, lengths, q_begin, t_begin, (q_begin, len(fragment) - q_end))
+  return q_begin, q_end, t_begin, t_end, alignment, alignment_score + left_score + right_score
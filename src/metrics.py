@@ -0,0 +1,182 @@
+import cProfile
+import functools
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from misc import log
+
+# Run-wide stage timers and counters. Timers add up the wall time spent inside a stage, summed
+# over all worker threads, so with several workers a stage can exceed the run's elapsed time.
+# Worker processes keep their own totals, drain() them per batch and the parent merge()s them.
+_lock = threading.Lock()
+_stages = {}
+_counters = {}
+# Stats of the batches profiled while a Profiler runs, merged into its dump
+_profiling = False
+_profiles = []
+
+@contextmanager
+def timer(stage):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - start
+    with _lock:
+      total, calls = _stages.get(stage, (0.0, 0))
+      _stages[stage] = (total + elapsed, calls + 1)
+
+def timed(stage):
+  def decorator(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      with timer(stage):
+        return function(*args, **kwargs)
+    return wrapper
+  return decorator
+
+def timed_iter(stage, iterable):
+  # Times the pulls from a lazy iterable (e.g. records parsed as they are consumed), not the
+  # work done by the consumer between them
+  iterator = iter(iterable)
+  elapsed = 0.0
+  try:
+    while True:
+      start = time.perf_counter()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      finally:
+        elapsed += time.perf_counter() - start
+      yield item
+  finally:
+    with _lock:
+      total, calls = _stages.get(stage, (0.0, 0))
+      _stages[stage] = (total + elapsed, calls + 1)
+
+def count(name, value=1):
+  with _lock:
+    _counters[name] = _counters.get(name, 0) + value
+
+@contextmanager
+def profiled():
+  # cProfile only sees the thread that enabled it, so while a Profiler runs each worker thread
+  # (or forked worker process) profiles the batches it maps itself. From Python 3.12 only one
+  # profiler can be active per process, the enable fails and the batches are left to the run's
+  # Profiler, which sees the worker threads but not the worker processes.
+  global _profiling
+  if not _profiling:
+    yield
+    return
+  profile = cProfile.Profile()
+  try:
+    profile.enable()
+  except ValueError as exc:
+    with _lock:
+      warn, _profiling = _profiling, False
+    if warn:
+      log(f'Profiling the main thread only: {exc}')
+    yield
+    return
+  try:
+    yield
+  finally:
+    profile.disable()
+    profile.create_stats()
+    with _lock:
+      _profiles.append(profile.stats)
+
+def drain():
+  # Returns and resets this process's totals
+  with _lock:
+    snapshot = (dict(_stages), dict(_counters), list(_profiles))
+    _stages.clear()
+    _counters.clear()
+    _profiles.clear()
+  return snapshot
+
+def merge(snapshot):
+  if snapshot is None:
+    return
+  stages, counters, profiles = snapshot
+  with _lock:
+    _profiles.extend(profiles)
+    for stage, (total, calls) in stages.items():
+      previous_total, previous_calls = _stages.get(stage, (0.0, 0))
+      _stages[stage] = (previous_total + total, previous_calls + calls)
+    for name, value in counters.items():
+      _counters[name] = _counters.get(name, 0) + value
+
+def summary(elapsed=None, extra=None):
+  with _lock:
+    stages = {stage: {'seconds': round(total, 6), 'calls': calls} for stage, (total, calls) in sorted(_stages.items())}
+    counters = dict(sorted(_counters.items()))
+  reads = counters.get('reads', 0)
+  if reads:
+    counters['anchors_per_read'] = round(counters.get('anchors', 0) / reads, 3)
+  result = {'elapsed_seconds': round(elapsed, 6) if elapsed is not None else None, 'stages': stages, 'counters': counters}
+  if extra:
+    result.update(extra)
+  return result
+
+def write_summary(result, json_path, tsv_path):
+  with open(json_path, 'w') as file:
+    json.dump(result, file, indent=2)
+  with open(tsv_path, 'w') as file:
+    file.write('kind\tname\tvalue\tcalls\n')
+    file.write(f'run\telapsed_seconds\t{result["elapsed_seconds"]}\t\n')
+    for stage, values in result['stages'].items():
+      file.write(f'stage\t{stage}\t{values["seconds"]}\t{values["calls"]}\n')
+    for name, value in result['counters'].items():
+      file.write(f'counter\t{name}\t{value}\t\n')
+
+class ProfileStats:
+  # A finished profile's stats dict in the form pstats.Stats.add() loads
+  def __init__(self, stats):
+    self.stats = stats
+
+  def create_stats(self):
+    pass
+
+class Profiler:
+  # Optional cProfile (written to profile_path, open with pstats or snakeviz) and tracemalloc
+  # capture around the run. Both cost enough that they are off unless asked for.
+  def __init__(self, profile_path=None, trace_memory=False, top=20):
+    self.profile_path = profile_path
+    self.trace_memory = trace_memory
+    self.top = top
+    self.profile = None
+    self.memory = None
+
+  def __enter__(self):
+    if self.trace_memory:
+      tracemalloc.start()
+    if self.profile_path:
+      global _profiling
+      _profiling = True
+      self.profile = cProfile.Profile()
+      self.profile.enable()
+    return self
+
+  def __exit__(self, *exc):
+    if self.profile is not None:
+      global _profiling
+      self.profile.disable()
+      _profiling = False
+      stats = pstats.Stats(self.profile)
+      with _lock:
+        profiles = list(_profiles)
+        _profiles.clear()
+      for profile_stats in profiles:
+        stats.add(ProfileStats(profile_stats))
+      stats.dump_stats(self.profile_path)
+    if self.trace_memory:
+      snapshot = tracemalloc.take_snapshot()
+      current, peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+      self.memory = {'current_bytes': current, 'peak_bytes': peak,
+                     'top_allocations': [{'location': str(stat.traceback), 'bytes': stat.size, 'count': stat.count} for stat in snapshot.statistics('lineno')[:self.top]]}
@@ -1,26 +1,137 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from reference import spanning_kmers
+from sequence import encode_sequence
+
+MAX_K = 31
+INVALID_HASH = np.iinfo(np.uint64).max
+# Windows per chunk of find_minimizer_arrays, bounds its temporaries whatever the genome size
+MINIMIZER_CHUNK = 1 << 18
+
+def encode_kmer(k_mer):
+  value = 0
+  for code in encode_sequence(k_mer):
+    if code > 3:
+      return None
+    value = (value << 2) | int(code)
+  return value
+
+def decode_kmer(value, k):
+  bases = []
+  for _ in range(k):
+    bases.append('ACGT'[value & 3])
+    value >>= 2
+  return ''.join(reversed(bases))
+
+def hash64(values, k):
+  # Invertible integer hash (Thomas Wang), gives a non-lexicographic k-mer order
+  mask = np.uint64((1 << (2 * k)) - 1)
+  with np.errstate(over='ignore'):
+    values = (~values + (values << np.uint64(21))) & mask
+    values = values ^ (values >> np.uint64(24))
+    values = ((values + (values << np.uint64(3))) + (values << np.uint64(8))) & mask
+    values = values ^ (values >> np.uint64(14))
+    values = ((values + (values << np.uint64(2))) + (values << np.uint64(4))) & mask
+    values = values ^ (values >> np.uint64(28))
+    values = (values + (values << np.uint64(31))) & mask
+  return values
+
+def kmer_values(codes, k, reverse_complement=False):
+  # Rolling 2-bit k-mer values, one vectorized shift/or pass per k-mer offset.
+  # With reverse_complement=True the value of each k-mer's reverse complement is returned.
+  n_kmers = len(codes) - k + 1
+  if n_kmers <= 0:
+    return np.empty(0, dtype=np.uint64), np.empty(0, dtype=bool)
+
+  values = np.zeros(n_kmers, dtype=np.uint64)
+  for j in range(k):
+    values <<= np.uint64(2)
+    if reverse_complement:
+      values |= (3 - (codes[k-1-j:k-1-j+n_kmers] & 3)).astype(np.uint64)
+    else:
+      values |= (codes[j:j+n_kmers] & 3).astype(np.uint64)
+
+  invalid = np.concatenate(([0], np.cumsum(codes > 3)))
+  valid = (invalid[k:] - invalid[:-k]) == 0
+  return values, valid
+
+def find_minimizer_arrays(sequence, k, w, hash_function='lexicographic', canonical=False, boundaries=None, distinct=False):
+  # k-mer value, position and strand of the minimizer of every window, or with distinct of
+  # every run of consecutive windows sharing one. The sequence is done MINIMIZER_CHUNK windows
+  # at a time, chunks overlapping by k + w - 2 bases, and only the results are concatenated.
+  if k > MAX_K:
+    raise ValueError(f'k must be at most {MAX_K} for 2-bit encoding, got {k}')
+  if hash_function not in ('lexicographic', 'hash64'):
+    raise ValueError(f'Unknown hash function: {hash_function}')
+
+  num_windows = len(sequence) - k - w + 2
+  chunks = []
+  last_position = -1
+  for begin in range(0, max(num_windows, 0), MINIMIZER_CHUNK):
+    end = min(begin + MINIMIZER_CHUNK, num_windows)
+    chunk_boundaries = np.asarray(boundaries, dtype=np.int64) - begin if boundaries is not None else None
+    values, positions, strands = chunk_minimizers(encode_sequence(sequence[begin:end + k + w - 2]), k, w, hash_function, canonical, chunk_boundaries)
+    positions += begin
+    if distinct and len(positions):
+      keep = np.concatenate(([positions[0] != last_position], positions[1:] != positions[:-1]))
+      last_position = int(positions[-1])
+      values, positions, strands = values[keep], positions[keep], strands[keep]
+    chunks.append((values, positions, strands))
+
+  if not chunks:
+    return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int8)
+  return tuple(np.concatenate(arrays) for arrays in zip(*chunks))
+
+def chunk_minimizers(codes, k, w, hash_function, canonical, boundaries):
+  values, valid = kmer_values(codes, k)
+  if boundaries is not None:
+    # k-mers across a contig boundary of a packed reference are not real sequence
+    valid &= ~spanning_kmers(len(codes), k, boundaries)
+  strands = np.zeros(len(values), dtype=np.int8)
+  if canonical:
+    # Canonical k-mer: the smaller of the k-mer and its reverse complement, strand 1 if
+    # it is the reverse complement. Palindromic k-mers have no strand and are skipped.
+    rc_values, _ = kmer_values(codes, k, reverse_complement=True)
+    strands = (rc_values < values).astype(np.int8)
+    valid &= rc_values != values
+    values = np.minimum(values, rc_values)
+
+  if len(values) < w:
+    return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int8)
+
+  hashes = values.copy() if hash_function == 'lexicographic' else hash64(values, k)
+  hashes[~valid] = INVALID_HASH
+
+  # argmin returns the leftmost minimum, same tie-breaking as the string scan
+  positions = np.arange(len(values) - w + 1) + np.argmin(sliding_window_view(hashes, w), axis=1)
+  has_minimizer = hashes[positions] != INVALID_HASH
+  positions = positions[has_minimizer]
+
+  return values[positions], positions, strands[positions]
+
 def find_window_minimizer(args):
   sequence, k, w, i,strand = args
   window = sequence[i:i+w+k-1]
   min_k_mer = window[:k]
   min_pos = 0
-  
+
   for j in range(1, w):
     k_mer = window[j:j+k]
-    
+
     if k_mer < min_k_mer:
       min_k_mer = k_mer
       min_pos = j
-    
+
   return (min_k_mer, i + min_pos, strand, k, w)
 
-def find_minimizers(sequence, k, w,strand):
-  n = len(sequence)
-  indices = range(n - w - k + 2)
-  windows = [(sequence, k, w, i,strand) for i in indices]
+def find_minimizers(sequence, k, w,strand, hash_function='lexicographic'):
+  # A PackedSequence reference is unpacked here, both paths slice and compare text
+  sequence = str(sequence)
+  if k > MAX_K:
+    # Too long for 64-bit k-mer values, fall back to the string scan
+    n = len(sequence)
+    return [find_window_minimizer((sequence, k, w, i, strand)) for i in range(n - w - k + 2)]
 
-  minimizers = []
-  for window in windows:
-    minimizers.append(find_window_minimizer(window))
+  _, positions, _ = find_minimizer_arrays(sequence, k, w, hash_function)
 
-  return minimizers
-   
\ No newline at end of file
+  return [(sequence[pos:pos+k], pos, strand, k, w) for pos in positions.tolist()]
@@ -1,11 +1,16 @@
 import argparse
-import os
-import sys
-from Bio import SeqIO
+
+# Debug flag, set once by set_debug (or parsed from the command line on first use)
+_debug = None
+
+def set_debug(debug):
+  global _debug
+  _debug = debug
 
 def log(message, level=0):
-  debug = parse_arguments().debug
-  if debug == True:
+  if _debug is None:
+    set_debug(parse_arguments().debug)
+  if _debug == True:
     indent = ''
     for _ in range(level):
       indent += '\t'
@@ -18,109 +23,40 @@ def write_output(message, output_filename='./output/output_temp.txt'):
 def parse_arguments():
   parser = argparse.ArgumentParser(description="Process reference genome and fragments files.")
   parser.add_argument('--reference', required=True, help="Path to the reference genome file (FASTA format).")
-  parser.add_argument('--fragments', required=True, help="Path to the fragments file (FASTA or FASTQ format).")
+  parser.add_argument('--fragments', help="Path to the fragments file (FASTA or FASTQ format), required unless --serve is given.")
   parser.add_argument('--debug', action='store_true', help="Enable debug mode.")
   parser.add_argument('--cigar', action='store_true', help="Include the CIGAR string in the output.")
   parser.add_argument('--threads', type=int, help="Number of threads to use.")
+  parser.add_argument('--engine', choices=['threads', 'processes'], default='threads', help="Run fragments in a thread pool or in worker processes sharing the reference and index.")
   parser.add_argument('--k', type=int, help="Value for parameter k.")
   parser.add_argument('--w', type=int, help="Value for parameter w.")
   parser.add_argument('--f', type=float, help="Value for parameter f.")
+  parser.add_argument('--align-mode', choices=['region', 'chain'], default='region', help="Align the whole padded region (reads over 5000 bp are skipped), or only the gaps between chained minimizer anchors (no read length cap).")
+  parser.add_argument('--band', type=int, help="Half-width of the alignment band (adaptive if not set).")
+  parser.add_argument('--max-band-cells', type=int, help="Keep only checkpoint rows of the alignment band when it would exceed this many cells, for about twice the alignment time (default 50000000).")
+  parser.add_argument('--min-chain-score', type=float, help="Skip fragments whose best chain scores below this (default 40).")
+  parser.add_argument('--max-chains', type=int, help="Number of chains kept per fragment, the rest are reported as secondary hits (default 5).")
+  parser.add_argument('--max-occurrences', type=int, help="Ignore fragment minimizers that occur more than this many times in the reference (default 200, 0 for no cap).")
+  parser.add_argument('--min-anchors', type=int, help="Skip fragments, and drop chains, with fewer anchors than this (default 3).")
+  parser.add_argument('--min-anchor-density', type=float, help="Skip fragments with fewer anchors per kb than this before chaining (default 1.0).")
+  parser.add_argument('--min-chain-coverage', type=float, help="Skip fragments whose best chain spans less than this fraction of the fragment (default 0.05).")
+  parser.add_argument('--x-drop', type=int, help="Extend alignments from the chain ends until the score drops this far below the best (default 40, 0 pads the anchored region by a fixed 50 bp instead).")
+  parser.add_argument('--sample', type=int, help="Map a uniform random sample of this many fragments instead of all of them.")
+  parser.add_argument('--seed', type=int, default=0, help="Random seed for --sample (default 0).")
+  parser.add_argument('--ordered', action='store_true', help="Write results in input order instead of as they complete.")
+  parser.add_argument('--index-dir', help="Directory for the cached reference minimizer index (reused when present).")
+  parser.add_argument('--rebuild-index', action='store_true', help="Rebuild the cached minimizer index even if it exists.")
+  parser.add_argument('--build-index', action='store_true', help="Only build the cached minimizer index, then exit.")
+  parser.add_argument('--serve', action='store_true', help="Keep the reference and index loaded and map reads sent over a local socket (see server.py).")
+  parser.add_argument('--socket', help="Unix domain socket path for --serve (default: localhost TCP on --port).")
+  parser.add_argument('--port', type=int, default=7878, help="Localhost TCP port for --serve (default 7878).")
+  parser.add_argument('--plot', choices=['coverage', 'reads', 'none'], default='coverage', help="Write a coverage track and read pileup as PNG and SVG next to the output (default), show one line per read in a window (small runs only), or skip plotting.")
+  parser.add_argument('--profile', action='store_true', help="Write a cProfile dump of the run next to the output, including the mapping in worker threads (and worker processes before Python 3.12).")
+  parser.add_argument('--trace-memory', action='store_true', help="Track allocations with tracemalloc and add the peak and top allocation sites to the metrics summary.")
   
-  return parser.parse_args()
-
-def load_file(file_path):
-  if not os.path.isfile(file_path):
-    print(f"Error: file '{file_path}' does not exist.", file=sys.stderr)
-    sys.exit(1)
-  file_extension = file_path.split('.')[-1]
-  with open(file_path, 'r') as file:
-    return file.read(), file_extension
+  args = parser.parse_args()
+  if not args.fragments and not (args.serve or args.build_index):
+    parser.error('--fragments is required unless --serve or --build-index is given')
+  return args
 
-def analyze(file_path, file_type):
-  with open(file_path, 'r') as file:
-    log(f"Analyzing file {file_path}...", 1)
-    contigs = list(SeqIO.parse(file, file_type))
-    contig_lengths = [len(record.seq) for record in contigs]
-    max_length = max(contig_lengths)
-    min_length = min(contig_lengths)
-    avg_length = sum(contig_lengths) / len(contig_lengths)
-    
-    sorted_lengths = sorted(contig_lengths, reverse=False)
-    total_length = sum(sorted_lengths)
-    half_total_length = total_length / 2
-    cumulative_length = 0
-    for length in sorted_lengths:
-      cumulative_length += length
-      if cumulative_length >= half_total_length:
-        n_50_length = length
-        break
-    
-    return len(contig_lengths), min_length, max_length, avg_length, n_50_length, contigs
-  
-
-def reverse_complement(seq):
-  complement = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
-  return ''.join(complement[base] for base in reversed(seq))
-  
 ###########################################################################################################################3
-
-def calculate_mapping_length(seq1, seq2):
-    """Calculate the mapping length (number of bases that are aligned and not gaps)."""
-    return sum(1 for a, b in zip(seq1, seq2) if a != '-' and b != '-')
-
-def calculate_number_of_matches(seq1, seq2):
-    """Calculate the number of matching bases."""
-    return sum(1 for a, b in zip(seq1, seq2) if a == b and a != '-' and b != '-')
-
-def write_paf(seq1, seq2, output_file, query_name="query", target_name="target",cigar=False):
-    query_length = len(seq1.replace('-', ''))
-    target_length = len(seq2.replace('-', ''))
-    mapping_length = calculate_mapping_length(seq1, seq2)
-    number_of_matches = calculate_number_of_matches(seq1, seq2)
-    mapping_quality = 60  # Placeholder for mapping quality, this usually requires a more complex calculation
-
-    # Find the start and end positions
-    query_start = seq1.find(seq1.lstrip('-'))
-    query_end = len(seq1.rstrip('-'))
-    target_start = seq2.find(seq2.lstrip('-'))
-    target_end = len(seq2.rstrip('-'))
-
-    with open(output_file, 'a') as f:
-        f.write(f"#query_name\t#query_length\t#query_start\t#query_end\t+\t")
-        f.write(f"#target_name\t#target_length\t#target_start\t#target_end\t")
-        f.write(f"#number_of_matches\t#mapping_length\t#mapping_quality\n")
-        
-        f.write(f"{query_name}\t{query_length}\t{query_start}\t{query_end}\t+\t")
-        f.write(f"{target_name}\t{target_length}\t{target_start}\t{target_end}\t")
-        f.write(f"{number_of_matches}\t{mapping_length}\t{mapping_quality}\t")
-        if cigar:
-            f.write(f"cg:Z:{generate_cigar(seq1, seq2)}")
-        f.write("\n")
-
-def generate_cigar(seq1, seq2):
-    cigar = []
-    count = 0
-    last = None
-
-    for s1, s2 in zip(seq1, seq2):
-        if s1 == s2:
-            operation = 'M'  # Match
-        elif s1 == '-':
-            operation = 'I'  # Insertion
-        elif s2 == '-':
-            operation = 'D'  # Deletion
-        else:
-            operation = 'X'  # Mismatch
-
-        if operation == last:
-            count += 1
-        else:
-            if last is not None:
-                cigar.append(f'{count}{last}')
-            count = 1
-        last = operation
-
-    if last is not None:
-        cigar.append(f'{count}{last}')
-
-    return ''.join(cigar)
@@ -0,0 +1,101 @@
+import os
+import queue
+import threading
+import metrics
+
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+def paf_line(query_name, query_length, q_begin, q_end, strand, target_name, target_length, t_begin, t_end, matches, block_length, mapping_quality, tags):
+  return '\t'.join(map(str, (query_name, query_length, q_begin, q_end, strand, target_name, target_length, t_begin, t_end, matches, block_length, mapping_quality) + tuple(tags))) + '\n'
+
+def paf_lines(query_name, result, contigs, cigar=False):
+  # Primary line for the aligned chain, then one tp:A:S line per secondary chain. Target names
+  # and lengths come from the reference's ContigTable.
+  fragment, target_name, q_begin, q_end, t_begin, t_end, alignment, alignment_score, secondary_hits, strand = result
+  matches, block_length, cigar_str = alignment.summary()
+  tags = ['tp:A:P', f'AS:i:{alignment_score}']
+  if cigar:
+    tags.append(f'cg:Z:{cigar_str}')
+  lines = [paf_line(query_name, len(fragment), q_begin, q_end, '+' if strand == 'original' else '-', target_name, contigs.length(target_name), t_begin, t_end, matches, block_length, 60, tags)]
+
+  for hit_strand, hit_q_begin, hit_q_end, hit_target, hit_t_begin, hit_t_end, chain_score in secondary_hits:
+    # Secondary chains are not aligned, the chain score stands in for the residue matches
+    hit_block_length = max(hit_q_end - hit_q_begin, hit_t_end - hit_t_begin)
+    lines.append(paf_line(query_name, len(fragment), hit_q_begin, hit_q_end, '+' if hit_strand == 'original' else '-', hit_target, contigs.length(hit_target), hit_t_begin, hit_t_end, min(int(chain_score), hit_block_length), hit_block_length, 0, ['tp:A:S']))
+  return lines
+
+class OutputWriter:
+  # Single writer thread for the text report and the PAF file. The mapping loop only queues
+  # results, formatting and writing happen here while the workers keep aligning. Both files
+  # stay open for the whole run with large buffers.
+  def __init__(self, report_filename, paf_filename, contigs, cigar=False, max_queued=256):
+    self.report_filename = report_filename
+    self.paf_filename = paf_filename
+    self.contigs = contigs
+    self.cigar = cigar
+    self.queue = queue.Queue(max_queued)
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.error = None
+    self.written = 0
+
+  def __enter__(self):
+    for filename in (self.report_filename, self.paf_filename):
+      os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    self.report = open(self.report_filename, 'a', buffering=OUTPUT_BUFFER_SIZE)
+    self.paf = open(self.paf_filename, 'w', buffering=OUTPUT_BUFFER_SIZE)
+    self.thread.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def write_result(self, query_name, result):
+    # Blocks when max_queued results are waiting, so a slow disk holds back the mapping loop
+    if self.error is not None:
+      raise self.error
+    self.queue.put((query_name, result))
+
+  def write_unmapped(self, query_name):
+    # Unmapped fragments are only listed in the text report, not in the PAF
+    self.write_result(query_name, None)
+
+  def close(self):
+    if self.thread.is_alive():
+      self.queue.put(None)
+      self.thread.join()
+    self.report.close()
+    self.paf.close()
+    if self.error is not None:
+      raise self.error
+
+  def run(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+      if self.error is not None:
+        continue
+      try:
+        self.format_result(*item)
+        self.written += 1
+      except Exception as exc:
+        self.error = exc
+
+  @metrics.timed('output')
+  def format_result(self, query_name, result):
+    if result is None:
+      metrics.count('bytes_written', self.report.write(f'{query_name}\tunmapped\n'))
+      return
+    fragment, ref_name, q_begin, q_end, t_begin, t_end, alignment, alignment_score, secondary_hits, strand = result
+    strand_char = '+' if strand == 'original' else '-'
+    aligned_seq1, aligned_seq2 = alignment.render()
+    written = 0
+
+    written += self.report.write(f'{aligned_seq1}\n{aligned_seq2}\n<><><><><><><><><><><><><><><><><><>\n{fragment}\n{ref_name}\n\tAlignment Score: {alignment_score}\n')
+    written += self.report.write(f'{fragment}\t{len(fragment)}\t{q_begin}\t{q_end}\t{strand_char}\t{ref_name}\t{self.contigs.length(ref_name)}\t{t_begin}\t{t_end}\t{alignment_score}\t60\n')
+    for hit_strand, hit_q_begin, hit_q_end, hit_target, hit_t_begin, hit_t_end, chain_score in secondary_hits:
+      hit_strand_char = '+' if hit_strand == 'original' else '-'
+      written += self.report.write(f'{fragment}\t{len(fragment)}\t{hit_q_begin}\t{hit_q_end}\t{hit_strand_char}\t{hit_target}\t{self.contigs.length(hit_target)}\t{hit_t_begin}\t{hit_t_end}\t{chain_score:.0f}\t0\ttp:A:S\n')
+
+    written += self.paf.write(''.join(paf_lines(query_name, result, self.contigs, self.cigar)))
+    metrics.count('bytes_written', written)
@@ -0,0 +1,196 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import shared_memory
+import numpy as np
+import metrics
+from index import MinimizerIndex, INDEX_ARRAYS
+from reader import read_batches
+from sequence import PackedSequence
+
+# Per-process state, filled once by init_worker so batches only carry the reads
+_worker = {}
+
+def share_array(array, blocks):
+  array = np.ascontiguousarray(array)
+  block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+  np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+  blocks.append(block)
+  return block.name, array.shape, array.dtype.str
+
+def attach_array(descriptor, blocks):
+  name, shape, dtype = descriptor
+  block = shared_memory.SharedMemory(name=name)
+  blocks.append(block)
+  return np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+def init_worker(reference_descriptor, index_descriptor, process, process_kwargs):
+  blocks = []
+  _worker['blocks'] = blocks
+  # The packed reference is used in place in shared memory, no copy per worker
+  arrays = {name: attach_array(reference_descriptor[name], blocks) for name in PackedSequence.ARRAYS}
+  _worker['reference_seq'] = PackedSequence(length=reference_descriptor['length'], offset=reference_descriptor['offset'], **arrays)
+
+  if isinstance(index_descriptor, dict):
+    arrays = {name: attach_array(index_descriptor[name], blocks) for name in INDEX_ARRAYS}
+    _worker['minimizer_index'] = MinimizerIndex(k=index_descriptor['k'], canonical=index_descriptor['canonical'], **arrays)
+  else:
+    # dict index (k > 31) is not array-backed, every worker gets its own copy
+    _worker['minimizer_index'] = index_descriptor
+
+  _worker['process'] = process
+  _worker['process_kwargs'] = process_kwargs
+  # Forked workers start with a copy of the parent's totals, only report their own
+  metrics.drain()
+
+def run_batch(state, batch, options=None):
+  # Result records drop the read sequence, the caller still has it in the batch. options
+  # override the pool's process_kwargs for this batch only.
+  process_kwargs = {**state['process_kwargs'], **options} if options else state['process_kwargs']
+  records = []
+  with metrics.profiled():
+    for index, name, fragment in batch:
+      try:
+        result = state['process'](index, fragment, reference_seq=state['reference_seq'], minimizer_index=state['minimizer_index'], **process_kwargs)
+        records.append((index, result[1:] if result is not None else None, None))
+      except Exception as exc:
+        records.append((index, None, repr(exc)))
+  return records
+
+def map_batch(batch, options=None):
+  # Worker processes send their stage timers and counters back with each batch
+  return run_batch(_worker, batch, options), metrics.drain()
+
+def bounded_map(executor, function, batches, max_in_flight):
+  # Yields (batch, function(batch)) as they complete. A new batch is only pulled from
+  # batches when fewer than max_in_flight are running, so the input is read at the pace
+  # the workers consume it.
+  pending = {}
+  for batch in batches:
+    pending[executor.submit(function, batch)] = batch
+    if len(pending) < max_in_flight:
+      continue
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+      yield pending.pop(future), future.result()
+
+  while pending:
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+      yield pending.pop(future), future.result()
+
+def collect_records(batch, records):
+  fragments = {index: (name, fragment) for index, name, fragment in batch}
+  for index, result, error in records:
+    name, fragment = fragments[index]
+    if result is not None:
+      result = (fragment,) + result
+    yield index, name, result, error
+
+def cost_batches(items, cost, workers, window=2048):
+  # Length-aware batches: reads up to window items at a time, sorts them by estimated cost and
+  # packs them into batches of about equal cost, most expensive first. Long reads start early
+  # instead of straggling at the end, short reads are grouped so batches are worth sending.
+  records = iter(items)
+  while True:
+    chunk = [(cost(item[2]), item) for _, item in zip(range(window), records)]
+    if not chunk:
+      return
+    chunk.sort(key=lambda entry: entry[0], reverse=True)
+    target = sum(entry[0] for entry in chunk) / (4 * workers)
+    batch, batch_cost = [], 0
+    for item_cost, item in chunk:
+      batch.append(item)
+      batch_cost += item_cost
+      if batch_cost >= target:
+        yield batch
+        batch, batch_cost = [], 0
+    if batch:
+      yield batch
+
+def in_input_order(records):
+  # Reorders (index, ...) records back to index order, indices must be 0, 1, 2, ... Only the
+  # records that finished ahead of a slower one are held.
+  held = {}
+  expected = 0
+  for record in records:
+    held[record[0]] = record
+    while expected in held:
+      yield held.pop(expected)
+      expected += 1
+  for index in sorted(held):
+    yield held[index]
+
+def map_fragments(items, process, process_kwargs, reference_seq, minimizer_index, workers, engine='threads', batch_size=None, cost=None, ordered=False):
+  # items is an iterable of (index, name, fragment), pulled lazily. Yields (index, name, result,
+  # error) per fragment as batches complete, result has the shape process(...) returns (None
+  # if the fragment was skipped). At most 2 * workers batches are in flight. With cost (a
+  # function of the fragment) batches are built by cost_batches instead of batch_size, with
+  # ordered the results come back in input order.
+  if cost is not None:
+    batches = cost_batches(items, cost, workers)
+  else:
+    batches = read_batches(items, batch_size or (16 if engine == 'processes' else 1))
+
+  if engine == 'processes':
+    records = map_fragments_in_processes(batches, process, process_kwargs, reference_seq, minimizer_index, workers)
+  else:
+    records = map_fragments_in_threads(batches, process, process_kwargs, reference_seq, minimizer_index, workers)
+  yield from in_input_order(records) if ordered else records
+
+def map_fragments_in_threads(batches, process, process_kwargs, reference_seq, minimizer_index, workers):
+  state = {'process': process, 'process_kwargs': process_kwargs, 'reference_seq': reference_seq, 'minimizer_index': minimizer_index}
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    for batch, records in bounded_map(executor, lambda batch: run_batch(state, batch), batches, 2 * workers):
+      yield from collect_records(batch, records)
+
+def share_reference_and_index(reference_seq, minimizer_index, blocks):
+  if not isinstance(reference_seq, PackedSequence):
+    reference_seq = PackedSequence.from_string(reference_seq)
+  reference_descriptor = {name: share_array(getattr(reference_seq, name), blocks) for name in PackedSequence.ARRAYS}
+  reference_descriptor['length'] = reference_seq.length
+  reference_descriptor['offset'] = reference_seq.offset
+  if isinstance(minimizer_index, MinimizerIndex):
+    index_descriptor = {name: share_array(getattr(minimizer_index, name), blocks) for name in INDEX_ARRAYS}
+    index_descriptor['k'] = minimizer_index.k
+    index_descriptor['canonical'] = minimizer_index.canonical
+  else:
+    index_descriptor = minimizer_index
+  return reference_descriptor, index_descriptor
+
+def map_fragments_in_processes(batches, process, process_kwargs, reference_seq, minimizer_index, workers):
+  blocks = []
+  try:
+    reference_descriptor, index_descriptor = share_reference_and_index(reference_seq, minimizer_index, blocks)
+    batches = ([(index, name, str(fragment)) for index, name, fragment in batch] for batch in batches)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(reference_descriptor, index_descriptor, process, process_kwargs)) as executor:
+      for batch, (records, worker_metrics) in bounded_map(executor, map_batch, batches, 2 * workers):
+        metrics.merge(worker_metrics)
+        yield from collect_records(batch, records)
+  finally:
+    for block in blocks:
+      block.close()
+      block.unlink()
+
+class FragmentPool:
+  # Long-lived pool for the server: the reference and index are shared with the workers once,
+  # then batches of (index, name, fragment) are submitted with their own options and come
+  # back as concurrent futures of (run_batch records, worker metrics or None)
+  def __init__(self, process, process_kwargs, reference_seq, minimizer_index, workers, engine='threads'):
+    self.blocks = []
+    if engine == 'processes':
+      reference_descriptor, index_descriptor = share_reference_and_index(reference_seq, minimizer_index, self.blocks)
+      self.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(reference_descriptor, index_descriptor, process, process_kwargs))
+      self.function = map_batch
+    else:
+      state = {'process': process, 'process_kwargs': process_kwargs, 'reference_seq': reference_seq, 'minimizer_index': minimizer_index}
+      self.executor = ThreadPoolExecutor(max_workers=workers)
+      self.function = lambda batch, options: (run_batch(state, batch, options), None)
+
+  def submit(self, batch, options=None):
+    return self.executor.submit(self.function, [(index, name, str(fragment)) for index, name, fragment in batch], options)
+
+  def close(self):
+    self.executor.shutdown()
+    for block in self.blocks:
+      block.close()
+      block.unlink()
+    self.blocks = []
@@ -0,0 +1,91 @@
+import gzip
+import os
+import random
+import sys
+from array import array
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+from sequence import PackedSequence
+
+FASTA_EXTENSIONS = ['fasta', 'fas', 'fa', 'fna', 'ffn', 'faa', 'mpfa', 'frn']
+FASTQ_EXTENSIONS = ['fastq', 'fq']
+
+class SequenceStats:
+  # Contig/read length statistics gathered while the file is streamed. Only the lengths are
+  # kept (8 bytes per record), so N50 can be computed at the end.
+  def __init__(self):
+    self.lengths = array('q')
+
+  def add(self, length):
+    self.lengths.append(length)
+
+  def summary(self):
+    # (contig_count, min, max, avg, n_50), same fields as misc.analyze used to return
+    if not self.lengths:
+      return 0, 0, 0, 0, 0
+    sorted_lengths = sorted(self.lengths)
+    half_total_length = sum(sorted_lengths) / 2
+    cumulative_length = 0
+    for length in sorted_lengths:
+      cumulative_length += length
+      if cumulative_length >= half_total_length:
+        n_50_length = length
+        break
+    return len(sorted_lengths), sorted_lengths[0], sorted_lengths[-1], sum(sorted_lengths) / len(sorted_lengths), n_50_length
+
+def file_type(file_path):
+  if not os.path.isfile(file_path):
+    print(f"Error: file '{file_path}' does not exist.", file=sys.stderr)
+    sys.exit(1)
+  parts = file_path.split('.')
+  extension = parts[-2] if parts[-1] == 'gz' and len(parts) > 2 else parts[-1]
+  if extension in FASTA_EXTENSIONS:
+    return 'fasta'
+  if extension in FASTQ_EXTENSIONS:
+    return 'fastq'
+  return extension
+
+def open_sequence_file(file_path):
+  if file_path.endswith('.gz'):
+    return gzip.open(file_path, 'rt')
+  return open(file_path, 'r')
+
+def read_records(file_path, stats=None, packed=False):
+  # Yields (name, sequence) one record at a time, FASTA or FASTQ, plain or gzip. With packed
+  # the sequences are PackedSequence (2 bits per base) instead of str.
+  filetype = file_type(file_path)
+  with open_sequence_file(file_path) as file:
+    if filetype == 'fastq':
+      records = ((title, sequence) for title, sequence, _ in FastqGeneralIterator(file))
+    else:
+      records = SimpleFastaParser(file)
+    for title, sequence in records:
+      if stats is not None:
+        stats.add(len(sequence))
+      yield title.split(None, 1)[0] if title else '', PackedSequence.from_string(sequence) if packed else sequence
+
+def read_batches(records, batch_size):
+  batch = []
+  for record in records:
+    batch.append(record)
+    if len(batch) == batch_size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+def reservoir_sample(records, size, max_length=None, rng=random):
+  # Uniform sample of at most size records in one pass, holding only the sample in memory
+  sample = []
+  seen = 0
+  for record in records:
+    if max_length is not None and len(record[1]) > max_length:
+      continue
+    seen += 1
+    if len(sample) < size:
+      sample.append(record)
+    else:
+      slot = rng.randrange(seen)
+      if slot < size:
+        sample[slot] = record
+  return sample
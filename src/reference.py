@@ -0,0 +1,94 @@
+import numpy as np
+from sequence import PackedSequence
+
+class ContigTable:
+  # Contigs of a reference packed end to end into one coordinate space. starts is sorted, so a
+  # packed position maps back to (contig, local position) with one binary search.
+  def __init__(self, names, lengths):
+    self.names = list(names)
+    self.lengths = np.asarray(lengths, dtype=np.int64)
+    self.starts = np.concatenate(([0], np.cumsum(self.lengths)[:-1])).astype(np.int64) if len(self.lengths) else np.empty(0, dtype=np.int64)
+    self.ids = {name: i for i, name in enumerate(self.names)}
+
+  def __len__(self):
+    return len(self.names)
+
+  def total_length(self):
+    return int(self.lengths.sum())
+
+  def boundaries(self):
+    # Packed positions where a contig other than the first begins
+    return self.starts[1:]
+
+  def contig_ids(self, positions):
+    return np.searchsorted(self.starts, positions, side='right') - 1
+
+  def locate(self, pos):
+    # Returns (contig id, local position) of a packed position
+    contig_id = int(self.contig_ids(pos))
+    return contig_id, int(pos - self.starts[contig_id])
+
+  def start(self, name):
+    return int(self.starts[self.ids[name]])
+
+  def length(self, name):
+    return int(self.lengths[self.ids[name]])
+
+  def view(self, sequence, contig_id):
+    start = int(self.starts[contig_id])
+    return ContigView(sequence, start, start + int(self.lengths[contig_id]))
+
+  def group(self, matches):
+    # Splits matches (pos, ref_pos, ...) by the contig of ref_pos, keeping their order
+    if len(self) == 1 or not matches:
+      return [matches]
+    ids = self.contig_ids(np.fromiter((match[1] for match in matches), dtype=np.int64, count=len(matches))).tolist()
+    groups = {}
+    for contig_id, match in zip(ids, matches):
+      groups.setdefault(contig_id, []).append(match)
+    return list(groups.values())
+
+class ContigView:
+  # Read-only str-like window of the packed reference in contig-local coordinates. Slices are
+  # clamped to the contig, so alignment windows never run into the neighbouring contig.
+  def __init__(self, sequence, start, end):
+    self.sequence = sequence
+    self.start = start
+    self.end = end
+
+  def __len__(self):
+    return self.end - self.start
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      begin, stop, _ = key.indices(len(self))
+      return self.sequence[self.start + begin:self.start + max(begin, stop)]
+    if not 0 <= key < len(self):
+      raise IndexError(key)
+    return self.sequence[self.start + key]
+
+  def __str__(self):
+    return str(self.sequence[self.start:self.end])
+
+def pack_contigs(records):
+  # Concatenates (name, sequence) records into one PackedSequence, returns it with its ContigTable
+  names, lengths = [], []
+  def sequences():
+    for name, sequence in records:
+      names.append(name)
+      lengths.append(len(sequence))
+      yield sequence
+  packed = PackedSequence.concatenate(sequences())
+  return packed, ContigTable(names, lengths)
+
+def spanning_kmers(length, k, boundaries):
+  # Boolean mask over the length - k + 1 k-mer start positions, True where the k-mer crosses
+  # one of the boundaries. Marks [b - k + 1, b) for every boundary b with a difference array.
+  count = max(0, length - k + 1)
+  if len(boundaries) == 0 or count == 0:
+    return np.zeros(count, dtype=bool)
+  boundaries = np.asarray(boundaries, dtype=np.int64)
+  marks = np.zeros(count + 1, dtype=np.int64)
+  np.add.at(marks, np.clip(boundaries - k + 1, 0, count), 1)
+  np.add.at(marks, np.clip(boundaries, 0, count), -1)
+  return np.cumsum(marks[:-1]) > 0
@@ -0,0 +1,135 @@
+import numpy as np
+
+# 2-bit base codes, A < C < G < T so integer order matches lexicographic order. N and the
+# IUPAC ambiguity codes (and anything else) are code 4, lowercase (soft-masked) bases are
+# read as uppercase.
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _bases in enumerate(('Aa', 'Cc', 'Gg', 'Tt')):
+  for _base in _bases:
+    BASE_CODES[ord(_base)] = _code
+
+CODE_BASES = np.frombuffer(b'ACGTN', dtype=np.uint8)
+COMPLEMENT_CODES = np.array([3, 2, 1, 0, 4], dtype=np.uint8)
+# For text, the IUPAC codes are complemented as well
+COMPLEMENT = str.maketrans('ACGTUNRYKMSWBDHVacgtunrykmswbdhv', 'TGCAANYRMKSWVHDBtgcaanyrmkswvhdb')
+SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+
+def encode_sequence(sequence):
+  # Code array (uint8, 0..4) of a str, PackedSequence or code array (returned as is)
+  if isinstance(sequence, np.ndarray):
+    return sequence
+  if isinstance(sequence, PackedSequence):
+    return sequence.codes()
+  return BASE_CODES[np.frombuffer(str(sequence).encode('ascii'), dtype=np.uint8)]
+
+def decode_codes(codes):
+  return CODE_BASES[codes].tobytes().decode('ascii')
+
+def reverse_complement(sequence):
+  # Same type out as in: str via a translation table, codes and packed sequences via a lookup
+  if isinstance(sequence, PackedSequence):
+    return sequence.reverse_complement()
+  if isinstance(sequence, np.ndarray):
+    return COMPLEMENT_CODES[sequence[::-1]]
+  return str(sequence).translate(COMPLEMENT)[::-1]
+
+def pack_codes(codes):
+  # 4 codes per byte, the first base in the high bits. Code 4 is stored as A, the unknown
+  # runs say where it was.
+  padded = np.zeros(-(-len(codes) // 4) * 4, dtype=np.uint8)
+  padded[:len(codes)] = codes & 3
+  quads = padded.reshape(-1, 4)
+  return (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+
+def unknown_runs(codes, offset=0):
+  # [start, end) of each run of code 4
+  edges = np.flatnonzero(np.diff(np.concatenate(([0], (codes > 3).view(np.int8), [0]))))
+  return edges[0::2].astype(np.int64) + offset, edges[1::2].astype(np.int64) + offset
+
+class PackedSequence:
+  # Read-only sequence stored at 2 bits per base, plus the sorted [start, end) runs of N and
+  # other non-ACGT bases, which all read back as N. Slicing is zero-copy: a slice is a view
+  # with its own offset into the same buffers. codes() unpacks a view to a uint8 code array.
+  ARRAYS = ('bits', 'unknown_starts', 'unknown_ends')
+
+  def __init__(self, bits, unknown_starts, unknown_ends, length, offset=0):
+    self.bits = bits
+    self.unknown_starts = unknown_starts
+    self.unknown_ends = unknown_ends
+    self.length = length
+    self.offset = offset
+
+  @classmethod
+  def from_codes(cls, codes):
+    return cls(pack_codes(codes), *unknown_runs(codes), len(codes))
+
+  @classmethod
+  def from_string(cls, text):
+    return cls.from_codes(encode_sequence(text))
+
+  @classmethod
+  def concatenate(cls, sequences):
+    # Packs the sequences one after another, holding only one of them unpacked at a time
+    chunks, starts, ends = [], [], []
+    carry = np.empty(0, dtype=np.uint8)
+    length = 0
+    for sequence in sequences:
+      codes = encode_sequence(sequence)
+      run_starts, run_ends = unknown_runs(codes, length)
+      starts.append(run_starts)
+      ends.append(run_ends)
+      length += len(codes)
+      codes = np.concatenate((carry, codes))
+      full = len(codes) // 4 * 4
+      chunks.append(pack_codes(codes[:full]))
+      carry = codes[full:]
+    chunks.append(pack_codes(carry))
+
+    # Runs touching across a sequence boundary are merged
+    starts, ends = np.concatenate(starts + [np.empty(0, dtype=np.int64)]), np.concatenate(ends + [np.empty(0, dtype=np.int64)])
+    separate = starts[1:] != ends[:-1]
+    starts = starts[np.concatenate(([True], separate))] if len(starts) else starts
+    ends = ends[np.concatenate((separate, [True]))] if len(ends) else ends
+    return cls(np.concatenate(chunks), starts, ends, length)
+
+  def __len__(self):
+    return self.length
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      begin, end, step = key.indices(self.length)
+      if step != 1:
+        raise ValueError('PackedSequence slices must be contiguous, use reverse_complement() or codes()[::-1]')
+      return PackedSequence(self.bits, self.unknown_starts, self.unknown_ends, max(0, end - begin), self.offset + begin)
+    if key < 0:
+      key += self.length
+    if not 0 <= key < self.length:
+      raise IndexError(key)
+    return decode_codes(self[key:key + 1].codes())
+
+  def codes(self):
+    begin, end = self.offset, self.offset + self.length
+    quads = self.bits[begin // 4:-(-end // 4)]
+    codes = ((quads[:, None] >> SHIFTS) & 3).reshape(-1)[begin % 4:begin % 4 + self.length]
+
+    first = np.searchsorted(self.unknown_ends, begin, side='right')
+    last = np.searchsorted(self.unknown_starts, end, side='left')
+    for run_start, run_end in zip(self.unknown_starts[first:last].tolist(), self.unknown_ends[first:last].tolist()):
+      codes[max(run_start, begin) - begin:min(run_end, end) - begin] = 4
+    return codes
+
+  def reverse_complement(self):
+    return PackedSequence.from_codes(COMPLEMENT_CODES[self.codes()[::-1]])
+
+  def __str__(self):
+    return decode_codes(self.codes())
+
+  def __eq__(self, other):
+    if isinstance(other, (PackedSequence, str)):
+      return len(self) == len(other) and np.array_equal(self.codes(), encode_sequence(other))
+    return NotImplemented
+
+  __hash__ = None
+
+  def nbytes(self):
+    return self.bits.nbytes + self.unknown_starts.nbytes + self.unknown_ends.nbytes
@@ -0,0 +1,235 @@
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+from collections import deque
+import numpy as np
+import metrics
+from misc import log
+from output import paf_lines
+from parallel import FragmentPool, collect_records
+
+# Persistent mapping server. The reference and its minimizer index are loaded once, clients
+# send reads over a Unix domain socket or localhost TCP and get PAF lines back as they are mapped.
+#
+# Protocol, one request after another on a connection:
+#   MAP [{"align_mode": "chain", "cigar": true, ...}]   FASTA or FASTQ records follow,
+#   >read1                                              ended by an END line (or EOF).
+#   ACGT...                                             PAF lines are streamed back as reads
+#   END                                                 finish, then "END <reads> <mapped>".
+#   STATUS                                              One JSON line with counters and latencies.
+# A read that fails is answered with an "ERROR <read> <message>" line among the PAF lines. A
+# request that fails as a whole (bad options, undecodable input, a broken worker pool) is
+# answered with a single "ERROR <message>" line and the connection is closed.
+
+# Options a MAP request may override, everything that does not change the index
+REQUEST_OPTIONS = ('band', 'align_mode', 'max_band_cells', 'min_chain_score', 'max_chains', 'x_drop', 'max_occurrences', 'min_anchors', 'min_anchor_density', 'min_chain_coverage', 'cigar')
+LATENCY_SAMPLES = 10000
+STREAM_LIMIT = 1 << 26
+
+def percentiles(samples):
+  if not samples:
+    return {'p50': None, 'p99': None}
+  p50, p99 = np.percentile(np.fromiter(samples, dtype=np.float64), [50, 99])
+  return {'p50': round(p50 * 1000, 3), 'p99': round(p99 * 1000, 3)}
+
+def error_line(message):
+  return f'ERROR {message}'.replace('\n', ' ').encode('ascii', 'backslashreplace') + b'\n'
+
+def record_name(title):
+  return title.split(None, 1)[0] if title else ''
+
+async def read_request_records(reader):
+  # Yields (name, sequence) from FASTA or (4-line) FASTQ text up to the END line or EOF
+  name, parts = None, []
+  while True:
+    line = await reader.readline()
+    if not line or line.rstrip() == b'END':
+      break
+    line = line.decode('ascii').rstrip('\r\n')
+    if not line:
+      continue
+    if line[0] == '>':
+      if name is not None:
+        yield name, ''.join(parts)
+      name, parts = record_name(line[1:]), []
+    elif line[0] == '@' and name is None:
+      sequence = (await reader.readline()).decode('ascii').strip()
+      await reader.readline()
+      await reader.readline()
+      yield record_name(line[1:]), sequence
+    else:
+      parts.append(line.strip())
+  if name is not None:
+    yield name, ''.join(parts)
+
+class MappingServer:
+  def __init__(self, pool, contigs, cigar=False, batch_size=4, max_in_flight=8):
+    self.pool = pool
+    self.contigs = contigs
+    self.cigar = cigar
+    self.batch_size = batch_size
+    self.max_in_flight = max_in_flight
+    self.started = time.time()
+    self.counters = {'clients': 0, 'requests': 0, 'reads': 0, 'mapped': 0, 'errors': 0}
+    self.request_latencies = deque(maxlen=LATENCY_SAMPLES)
+    self.read_latencies = deque(maxlen=LATENCY_SAMPLES)
+
+  def status(self):
+    return {'uptime_s': round(time.time() - self.started, 3), **self.counters,
+            'request_latency_ms': percentiles(self.request_latencies), 'read_latency_ms': percentiles(self.read_latencies),
+            'metrics': metrics.summary()}
+
+  def request_options(self, text):
+    options = json.loads(text) if text.strip() else {}
+    if not isinstance(options, dict):
+      raise ValueError('MAP options must be a JSON object')
+    unknown = set(options) - set(REQUEST_OPTIONS)
+    if unknown:
+      raise ValueError(f'Unknown or fixed options: {", ".join(sorted(unknown))}, allowed: {", ".join(REQUEST_OPTIONS)}')
+    cigar = options.pop('cigar', self.cigar)
+    return options, cigar
+
+  async def handle_client(self, reader, writer):
+    self.counters['clients'] += 1
+    try:
+      while True:
+        line = await reader.readline()
+        if not line:
+          break
+        command, _, argument = line.decode('ascii').strip().partition(' ')
+        if command == 'STATUS':
+          writer.write((json.dumps(self.status()) + '\n').encode('ascii'))
+        elif command == 'MAP':
+          try:
+            options, cigar = self.request_options(argument)
+          except ValueError as exc:
+            async for _ in read_request_records(reader):
+              pass
+            writer.write(error_line(exc))
+            await writer.drain()
+            break
+          await self.map_request(reader, writer, options, cigar)
+        elif command:
+          writer.write(error_line(f'Unknown command: {command}'))
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    except Exception as exc:
+      # Undecodable input or a failed worker future, the client still gets an answer
+      self.counters['errors'] += 1
+      log(f'Request failed: {exc!r}')
+      try:
+        writer.write(error_line(repr(exc)))
+        await writer.drain()
+      except ConnectionError:
+        pass
+    finally:
+      self.counters['clients'] -= 1
+      writer.close()
+
+  async def map_request(self, reader, writer, options, cigar):
+    started = time.perf_counter()
+    self.counters['requests'] += 1
+    pending = {}
+    reads, mapped = 0, 0
+
+    async def write_completed():
+      nonlocal mapped
+      done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+      for future in done:
+        batch, submitted = pending.pop(future)
+        latency = time.perf_counter() - submitted
+        records, worker_metrics = future.result()
+        metrics.merge(worker_metrics)
+        for _, name, result, error in collect_records(batch, records):
+          self.read_latencies.append(latency)
+          if error is not None:
+            self.counters['errors'] += 1
+            log(f'Fragment {name} generated an exception: {error}')
+            writer.write(error_line(f'{name} {error}'))
+          elif result is not None:
+            mapped += 1
+            data = ''.join(paf_lines(name, result, self.contigs, cigar)).encode('ascii')
+            metrics.count('bytes_written', len(data))
+            writer.write(data)
+      await writer.drain()
+
+    def submit(batch):
+      pending[asyncio.wrap_future(self.pool.submit(batch, options))] = (batch, time.perf_counter())
+
+    batch = []
+    async for name, sequence in read_request_records(reader):
+      batch.append((reads, name, sequence))
+      reads += 1
+      if len(batch) == self.batch_size:
+        submit(batch)
+        batch = []
+        while len(pending) >= self.max_in_flight:
+          await write_completed()
+    if batch:
+      submit(batch)
+    while pending:
+      await write_completed()
+
+    self.counters['reads'] += reads
+    self.counters['mapped'] += mapped
+    writer.write(f'END {reads} {mapped}\n'.encode('ascii'))
+    self.request_latencies.append(time.perf_counter() - started)
+
+async def run_server(server, socket_path=None, port=None):
+  if socket_path:
+    listener = await asyncio.start_unix_server(server.handle_client, path=socket_path, limit=STREAM_LIMIT)
+    log(f'Listening on {socket_path}', 0)
+  else:
+    listener = await asyncio.start_server(server.handle_client, host='127.0.0.1', port=port, limit=STREAM_LIMIT)
+    log(f'Listening on 127.0.0.1:{port}', 0)
+
+  stop = asyncio.Event()
+  loop = asyncio.get_running_loop()
+  for signum in (signal.SIGINT, signal.SIGTERM):
+    loop.add_signal_handler(signum, stop.set)
+  async with listener:
+    await stop.wait()
+
+def serve(process, process_kwargs, reference_seq, minimizer_index, contigs, workers, engine='threads', socket_path=None, port=None, cigar=False):
+  # Blocks until SIGINT/SIGTERM. process_kwargs are the defaults each MAP request starts from.
+  pool = FragmentPool(process, process_kwargs, reference_seq, minimizer_index, workers, engine)
+  server = MappingServer(pool, contigs, cigar, max_in_flight=2 * workers)
+  try:
+    asyncio.run(run_server(server, socket_path, port))
+  finally:
+    pool.close()
+    if socket_path and os.path.exists(socket_path):
+      os.remove(socket_path)
+
+async def send_file(file_path, options, socket_path=None, port=None):
+  # Minimal client: maps one FASTA/FASTQ file and prints the PAF lines
+  if socket_path:
+    reader, writer = await asyncio.open_unix_connection(socket_path, limit=STREAM_LIMIT)
+  else:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=STREAM_LIMIT)
+  writer.write(f'MAP {options}\n'.encode('ascii'))
+  with open(file_path, 'rb') as file:
+    for line in file:
+      writer.write(line)
+      await writer.drain()
+  writer.write(b'\nEND\n')
+  await writer.drain()
+  while True:
+    line = (await reader.readline()).decode('ascii')
+    if line.startswith('ERROR'):
+      print(line.rstrip('\n'), file=sys.stderr)
+      continue
+    if not line or line.startswith('END'):
+      print(line.rstrip('\n'), file=sys.stderr)
+      break
+    sys.stdout.write(line)
+  writer.close()
+
+# Usage: python server.py (--socket <path> | --port <port>) <reads.fasta> ['{"cigar": true}']
+if __name__ == '__main__':
+  address = {'socket_path': sys.argv[2]} if sys.argv[1] == '--socket' else {'port': int(sys.argv[2])}
+  asyncio.run(send_file(sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else '', **address))
@@ -1,6 +1,117 @@
-import matplotlib.pyplot as plt
+import random
+import numpy as np
+
+# matplotlib is imported inside the plotting functions, runs that don't plot never load it
+
+PLOT_FORMATS = ('png', 'svg')
+COVERAGE_BINS = 4000
+PILEUP_READS = 2000
+PILEUP_ROWS = 100
+CONTIG_LABELS = 30
+
+class CoverageTrack:
+    # Mean depth of each bin of the reference and a pileup sample, updated one alignment at a
+    # time so their memory is fixed whatever the number of reads. The covered bases left of x
+    # are sum(max(x - begin, 0) - max(x - end, 0)), so each begin/end adds its sign and its
+    # sign * position to the first bin edge right of it, and the bin edge totals follow from
+    # one cumulative sum. The pileup keeps a uniform reservoir of at most max_reads alignments.
+    def __init__(self, reference_length, bins=COVERAGE_BINS, max_reads=PILEUP_READS, seed=0):
+        self.reference_length = reference_length
+        self.bin_size = max(1, -(-reference_length // bins))
+        num_bins = -(-reference_length // self.bin_size)
+        self.edges = np.minimum(np.arange(num_bins + 1, dtype=np.int64) * self.bin_size, reference_length)
+        self.slopes = np.zeros(num_bins + 1, dtype=np.int64)
+        self.offsets = np.zeros(num_bins + 1, dtype=np.int64)
+        self.max_reads = max_reads
+        self.sample = []
+        self.reads = 0
+        self.rng = random.Random(seed)
+
+    def add(self, t_begin, t_end):
+        for position, sign in ((t_begin, 1), (t_end, -1)):
+            slot = min(position // self.bin_size + 1, len(self.edges) - 1)
+            self.slopes[slot] += sign
+            self.offsets[slot] += sign * position
+        self.reads += 1
+        if len(self.sample) < self.max_reads:
+            self.sample.append((t_begin, t_end))
+        else:
+            slot = self.rng.randrange(self.reads)
+            if slot < self.max_reads:
+                self.sample[slot] = (t_begin, t_end)
+
+    def depth(self):
+        covered = self.edges * np.cumsum(self.slopes) - np.cumsum(self.offsets)
+        return np.diff(covered) / np.maximum(np.diff(self.edges), 1), self.edges
+
+def pileup_rows(t_begins, t_ends, max_reads=PILEUP_READS, max_rows=PILEUP_ROWS):
+    # Evenly spaced reads along the reference (at most max_reads), each put on the first
+    # row that is free at its start. Returns (begins, ends, rows) of the reads that fit.
+    order = np.argsort(t_begins, kind='stable')
+    if len(order) > max_reads:
+        order = order[np.linspace(0, len(order) - 1, max_reads).astype(np.int64)]
+    begins, ends = np.asarray(t_begins)[order], np.asarray(t_ends)[order]
+
+    row_ends = np.full(max_rows, -1, dtype=np.int64)
+    rows = np.full(len(order), -1, dtype=np.int64)
+    for i, (begin, end) in enumerate(zip(begins.tolist(), ends.tolist())):
+        free = np.flatnonzero(row_ends < begin)
+        if len(free):
+            rows[i] = free[0]
+            row_ends[free[0]] = end
+    placed = rows >= 0
+    return begins[placed], ends[placed], rows[placed]
+
+def plot_coverage(track, output_prefix, contigs=None, formats=PLOT_FORMATS):
+    # Coverage track and a downsampled read pileup of a CoverageTrack, written as
+    # <output_prefix>.coverage.<format>. Draws a fixed number of artists whatever the number
+    # of reads, no interactive backend.
+    from matplotlib.figure import Figure
+    from matplotlib.collections import LineCollection
+
+    reference_length = track.reference_length
+    depth, edges = track.depth()
+
+    fig = Figure(figsize=(15, 6))
+    coverage_ax, pileup_ax = fig.subplots(2, 1, sharex=True, gridspec_kw={'height_ratios': [1, 2]})
+    if len(depth):
+        coverage_ax.stairs(depth, edges, fill=True, color='tab:blue')
+    coverage_ax.set_ylabel(f'Mean depth ({track.bin_size} bp bins)')
+    coverage_ax.set_title(f'Mapped Genome Coverage ({track.reads} alignments)')
+    coverage_ax.grid(True)
+
+    t_begins = np.array([begin for begin, _ in track.sample], dtype=np.int64)
+    t_ends = np.array([end for _, end in track.sample], dtype=np.int64)
+    begins, ends, rows = pileup_rows(t_begins, t_ends)
+    segments = np.stack((np.stack((begins, rows), axis=1), np.stack((ends, rows), axis=1)), axis=1)
+    pileup_ax.add_collection(LineCollection(segments, linewidths=2, colors='tab:orange'))
+    pileup_ax.set_ylim(-1, max(int(rows.max()) + 1 if len(rows) else 1, 1))
+    pileup_ax.invert_yaxis()
+    pileup_ax.set_yticks([])
+    pileup_ax.set_ylabel(f'Reads ({len(rows)} of {track.reads} shown)')
+    pileup_ax.set_xlabel('Reference Genome Position')
+    pileup_ax.set_xlim(0, max(reference_length, 1))
+
+    # Contigs are packed one after another, their starts are marked
+    if contigs is not None and len(contigs) > 1:
+        for ax in (coverage_ax, pileup_ax):
+            for start in contigs.boundaries().tolist():
+                ax.axvline(start, color='grey', linewidth=0.5)
+        if len(contigs) <= CONTIG_LABELS:
+            for name, start in zip(contigs.names, contigs.starts.tolist()):
+                coverage_ax.annotate(name, (start, 1), xycoords=('data', 'axes fraction'), fontsize=7, va='bottom')
+
+    paths = []
+    for file_format in formats:
+        path = f'{output_prefix}.coverage.{file_format}'
+        fig.savefig(path, format=file_format, bbox_inches='tight')
+        paths.append(path)
+    return paths
 
 def plot_mapped_genome(results, reference_length):
+    # One line per read in an interactive window, only usable for a handful of reads
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots(figsize=(15, 5))
     
     # Plot the reference genome as a horizontal line
@@ -8,7 +119,7 @@ def plot_mapped_genome(results, reference_length):
     
     # Plot each fragment as a horizontal line positioned below the reference genome
     for idx, result in enumerate(results):
-        fragment_result, ref_name, q_begin, q_end, t_begin, t_end, aligned_seq1, aligned_seq2, alignment_score, cigar = result
+        fragment_result, ref_name, q_begin, q_end, t_begin, t_end, alignment, alignment_score = result[:8]
         y_position = -(idx + 1)
         ax.plot([t_begin, t_end], [y_position, y_position], marker='o', label=f'Fragment {idx+1}')
 